@@ -0,0 +1,345 @@
+""" Benchmarks of the validators, the actors and the whole /put pipeline
+
+Run from the repository root, e.g.:
+    $ python -m benchmarks.bench run --n 1000 --out bench.json
+    $ python -m benchmarks.bench compare old.json bench.json
+
+The results are written as json, so they can be compared between
+commits. Mongo and S3 are replaced by in-memory stand-ins.
+"""
+from benchmarks import standins
+from librarian import validators
+from librarian import actors
+from librarian import factory
+from librarian.clients import clients
+from librarian.validators.exceptions import ValidationError
+from werkzeug.datastructures import FileStorage
+from contextlib import redirect_stdout, redirect_stderr
+from io import BytesIO
+import base64
+import fire
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run(n=500, out=None, only=None, image_size=256, seed=0):
+    """ Run the benchmarks and write the results as json
+
+    Args:
+        n (int): Calls per micro-benchmark and requests per pipeline run
+        out (str): File to write the results to. Defaults to stdout.
+        only (str): Run only the benchmarks whose name starts with this,
+            e.g. "validator", "actor/mongo" or "put"
+        image_size (int): Width and height of the test images
+        seed (int): Seed for the test data
+
+    """
+    random.seed(seed)
+    # Replace the remote services:
+    clients.factories['mongo'] = standins.MongoClient
+    clients.factories['s3'] = standins.S3Client
+    images = [_image(image_size, i) for i in range(16)]
+    tmp = tempfile.mkdtemp(prefix='librarian-bench-')
+    # Every registered validator and actor, skipped if there is no case:
+    benchmarks = []
+    for tag in validators.validators:
+        benchmarks.append((f"validator/{tag}", _validator, tag,
+                           VALIDATOR_CASES))
+    for tag in validators.xvalidators:
+        benchmarks.append((f"xvalidator/{tag}", _xvalidator, tag,
+                           XVALIDATOR_CASES))
+    for tag in actors.actors:
+        benchmarks.append((f"actor/{tag}", _actor, tag, ACTOR_CASES))
+    for datatype in PIPELINES:
+        benchmarks.append((f"put/{datatype}", _pipeline, datatype,
+                           PIPELINES))
+
+    results = []
+    try:
+        for name, bench, tag, cases in benchmarks:
+            if only and not name.startswith(only):
+                continue
+            if tag not in cases:
+                results.append({'name': name, 'skipped': "No benchmark case"})
+                continue
+            print("Running", name, file=sys.stderr)
+            try:
+                # The validators and actors print a lot:
+                with open(os.devnull, 'w') as null, \
+                        redirect_stdout(null), redirect_stderr(null):
+                    result = bench(tag, n=n, images=images,
+                                   tmp=os.path.join(tmp, name))
+            except ImportError as e:
+                result = {'skipped': f"Missing dependency: {e}"}
+            results.append({'name': name, **result})
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {'meta': _meta(n, image_size, seed), 'results': results}
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+def compare(old, new, threshold=0.1):
+    """ Compare the median times of two result files
+
+    Args:
+        old (str): Results of the baseline
+        new (str): Results to compare to it
+        threshold (float): Relative change to flag as slower or faster
+
+    """
+    with open(old) as f:
+        before = {r['name']: r for r in json.load(f)['results']}
+    with open(new) as f:
+        after = {r['name']: r for r in json.load(f)['results']}
+    for name, result in after.items():
+        base = before.get(name)
+        if base is None or 'median_us' not in base \
+                or 'median_us' not in result:
+            continue
+        change = result['median_us'] / base['median_us'] - 1
+        flag = ''
+        if change > threshold:
+            flag = 'SLOWER'
+        elif change < -threshold:
+            flag = 'faster'
+        print(f"{name:28s} {base['median_us']:12.1f} us "
+              f"{result['median_us']:12.1f} us {change:+8.1%} {flag}")
+
+
+# Micro-benchmarks: tag: function(tmp, images) returning the
+# (args, kwargs) of the validator or actor and a function creating
+# the i:th input.
+
+def _labels(i):
+    return {'filename': f"{i}.jpg", 'x': i % 640, 'y': i % 480,
+            'label': 'cat'}
+
+
+VALIDATOR_CASES = {
+    'file': lambda tmp, images: (
+        [['.png', '.jpg']], {}, lambda i: _file(images[i % len(images)], i)),
+    'type': lambda tmp, images: (
+        [{'filename': 'str', 'x': 'int', 'y': 'int', 'label': 'str'}], {},
+        _labels),
+    'key': lambda tmp, images: (
+        [['filename', 'x', 'y', 'label']], {}, _labels),
+    'range': lambda tmp, images: (
+        [{'x': {'min': 0, 'max': 640}, 'y': {'min': 0, 'max': 480}}], {},
+        _labels),
+    'img': lambda tmp, images: (
+        [], {'h': 0, 'w': 0}, lambda i: _file(images[i % len(images)], i)),
+    'dhash': lambda tmp, images: (
+        [os.path.join(tmp, 'hashes.bin')], {'distance': 4},
+        lambda i: _file(images[i % len(images)], i)),
+    'none': lambda tmp, images: ([], {}, _labels),
+}
+
+XVALIDATOR_CASES = {
+    'fname': lambda tmp, images: (
+        [], {}, lambda i: (_labels(i), {'filename': f"{i}.jpg"})),
+    'none': lambda tmp, images: (
+        [], {}, lambda i: (_labels(i), _file(images[i % len(images)], i))),
+}
+
+ACTOR_CASES = {
+    'S3': lambda tmp, images: (
+        ['key', 'secret', 'bench'], {},
+        lambda i: _file(images[i % len(images)], i)),
+    'mongo': lambda tmp, images: (
+        ['usr', 'pwd', 'localhost', 'bench', 'labels'], {}, _labels),
+    'file': lambda tmp, images: (
+        [tmp], {}, lambda i: _file(images[i % len(images)], i)),
+    'json': lambda tmp, images: (
+        [os.path.join(tmp, 'labels.json')], {}, _labels),
+    'jsonl': lambda tmp, images: (
+        [os.path.join(tmp, 'labels.jsonl')], {}, _labels),
+    'none': lambda tmp, images: ([], {}, _labels),
+    'print': lambda tmp, images: ([], {}, _labels),
+    'image': lambda tmp, images: (
+        [tmp], {}, lambda i: _file(images[i % len(images)], i)),
+}
+
+
+def _validator(tag, n, images, tmp):
+    os.makedirs(tmp)
+    args, kwargs, make = VALIDATOR_CASES[tag](tmp, images)
+    validate = validators.validators[tag](*args, **kwargs)
+    return _measure(validate, [(make(i),) for i in range(n + WARMUP)])
+
+
+def _xvalidator(tag, n, images, tmp):
+    os.makedirs(tmp)
+    args, kwargs, make = XVALIDATOR_CASES[tag](tmp, images)
+    validate = validators.xvalidators[tag](*args, **kwargs)
+    return _measure(validate, [make(i) for i in range(n + WARMUP)])
+
+
+def _actor(tag, n, images, tmp):
+    os.makedirs(tmp)
+    args, kwargs, make = ACTOR_CASES[tag](tmp, images)
+    actor = actors.actors[tag](*args, **kwargs)
+    return _measure(actor.act, [(make(i), f"{i:024x}")
+                                for i in range(n + WARMUP)])
+
+
+# End-to-end: datatype: (label validator, data validator, label actor,
+# data actor) configs, and a function creating the i:th request
+
+PIPELINES = {
+    'file': (
+        [{'validator': 'type', 'args': [{'x': 'int', 'y': 'int'}]}],
+        [{'validator': 'file', 'args': [['.jpg']]},
+         {'validator': 'img', 'args': [0, 0]}],
+        [{'actor': 'jsonl', 'args': ['{tmp}/labels.jsonl']}],
+        [{'actor': 'image', 'args': ['{tmp}/images']}],
+    ),
+    'base64': (
+        [{'validator': 'type', 'args': [{'x': 'int', 'y': 'int'}]}],
+        [{'validator': 'img', 'args': [0, 0]}],
+        [{'actor': 'jsonl', 'args': ['{tmp}/labels.jsonl']}],
+        [{'actor': 'image', 'args': ['{tmp}/images']}],
+    ),
+    'json': (
+        [{'validator': 'type', 'args': [{'x': 'int', 'y': 'int'}]}],
+        [{'validator': 'type', 'args': [{'label': 'str'}]}],
+        [{'actor': 'jsonl', 'args': ['{tmp}/labels.jsonl']}],
+        [{'actor': 'jsonl', 'args': ['{tmp}/data.jsonl']}],
+    ),
+}
+
+
+def _request(datatype, image, i):
+    url = f"/put?x={i % 640}&y={i % 480}&filename={i}.jpg"
+    if datatype == 'file':
+        return url, {'data': {'data': (BytesIO(image), f"{i}.jpg")}}
+    if datatype == 'base64':
+        return url, {'data': {'data': base64.b64encode(image).decode()}}
+    return url, {'json': {'data': _labels(i)}}
+
+
+def _pipeline(datatype, n, images, tmp):
+    os.makedirs(tmp)
+    configs = [json.loads(json.dumps(c).replace('{tmp}', tmp))
+               for c in PIPELINES[datatype]]
+    lbl_valid, data_valid, lbl_actor, data_actor = configs
+    app = factory.create_librarian(
+        datatype=datatype, datatag='data',
+        label_validator=validators.configure_validator(lbl_valid),
+        label_actor=actors.configure_actor(lbl_actor),
+        data_validator=validators.configure_validator(data_valid),
+        data_actor=actors.configure_actor(data_actor),
+        cross_validator=validators.configure_xvalidator([]),
+    )
+    client = app.test_client()
+    requests = [_request(datatype, images[i % len(images)], i)
+                for i in range(n + WARMUP)]
+
+    def put(url, kwargs):
+        response = client.post(url, **kwargs)
+        if response.status_code != 200:
+            raise ValidationError(response.get_json())
+    return _measure(put, requests)
+
+
+# Calls made before the timed ones, with inputs of their own:
+WARMUP = 5
+
+
+def _measure(call, inputs):
+    """ Time a call for every input but the first WARMUP ones
+
+        The inputs are not reused, as the data objects cache what is
+        computed from them.
+
+        Returns (dict):
+            Number of calls and rejections, the total time, and the
+            statistics of the call times in microseconds
+    """
+    for args in inputs[:WARMUP]:
+        try:
+            call(*args)
+        except ValidationError:
+            pass
+    times = []
+    rejected = 0
+    for args in inputs[WARMUP:]:
+        start = time.perf_counter()
+        try:
+            call(*args)
+        except ValidationError:
+            rejected += 1
+        times.append(time.perf_counter() - start)
+    times_us = sorted(t * 1e6 for t in times)
+    total = sum(times)
+    return {
+        'n': len(times),
+        'rejected': rejected,
+        'total_s': total,
+        'ops_per_s': len(times) / total if total else None,
+        'mean_us': statistics.mean(times_us),
+        'median_us': statistics.median(times_us),
+        'p95_us': times_us[int(0.95 * (len(times_us) - 1))],
+        'p99_us': times_us[int(0.99 * (len(times_us) - 1))],
+    }
+
+
+def _image(size, seed):
+    """ A JPEG of random shapes, different for every seed """
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    im = Image.new('RGB', (size, size), tuple(rng.choices(range(256), k=3)))
+    draw = ImageDraw.Draw(im)
+    for _ in range(8):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        x1, y1 = rng.randrange(x0, size + 1), rng.randrange(y0, size + 1)
+        draw.rectangle([x0, y0, x1, y1],
+                       fill=tuple(rng.choices(range(256), k=3)))
+    out = BytesIO()
+    im.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def _file(content, i):
+    return FileStorage(stream=BytesIO(content), filename=f"{i}.jpg",
+                       name='data')
+
+
+def _meta(n, image_size, seed):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'n': n,
+        'image_size': image_size,
+        'seed': seed,
+    }
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        'run': run,
+        'compare': compare,
+    })
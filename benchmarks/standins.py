@@ -0,0 +1,97 @@
+""" In-memory stand-ins for the remote services used by the actors
+
+The stand-ins replace the pymongo and boto3 clients in the shared
+client registry, so that the benchmarks measure Librarian and not the
+network. Only the calls made by the actors are implemented.
+"""
+import copy
+import itertools
+import threading
+
+
+class MongoClient:
+    """ Stand-in for a pymongo client """
+    def __init__(self, **params):
+        self.dbs = {}
+
+    def __getitem__(self, db):
+        return self.dbs.setdefault(db, _Database())
+
+
+class _Database(dict):
+    def __missing__(self, col):
+        self[col] = Collection()
+        return self[col]
+
+
+class Collection:
+    """ Stand-in for a pymongo collection """
+    def __init__(self):
+        self.docs = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def insert_one(self, doc):
+        with self._lock:
+            doc.setdefault('_id', next(self._ids))
+            self.docs.append(copy.deepcopy(doc))
+        return doc['_id']
+
+    def insert_many(self, docs, ordered=True):
+        return [self.insert_one(doc) for doc in docs]
+
+    def find(self, q=None, projection=None, batch_size=0):
+        q = q or {}
+        with self._lock:
+            found = [d for d in self.docs
+                     if all(d.get(k) == v for k, v in q.items())]
+        return Cursor(found)
+
+
+class Cursor(list):
+    """ Stand-in for a pymongo cursor """
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            super().sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        return Cursor(self[:n])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class S3Client:
+    """ Stand-in for a boto3 S3 client """
+    def __init__(self, **params):
+        self.objects = {}
+        self.uploads = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(next(self._ids))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(
+            parts[p['PartNumber']] for p in MultipartUpload['Parts']
+        )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
@@ -1,17 +1,16 @@
-from librarian.actors import local_actors
-from librarian.actors import mongoactor
-from librarian.actors import s3actor
-from librarian.actors import actor
-
-actors = {
-    'S3': s3actor.S3Actor,
-    'mongo': mongoactor.MongoActor,
-    'file': local_actors.FileActor,
-    'json': local_actors.JsonActor,
-    'none': local_actors.DummyActor,
-    'print': local_actors.PrinterActor,
-    'image': local_actors.ImageActor,
-}
+from librarian.registry import LazyRegistry
+
+# The modules are imported when the actors are first configured:
+actors = LazyRegistry({
+    'S3': 'librarian.actors.s3actor:S3Actor',
+    'mongo': 'librarian.actors.mongoactor:MongoActor',
+    'file': 'librarian.actors.local_actors:FileActor',
+    'json': 'librarian.actors.local_actors:JsonActor',
+    'jsonl': 'librarian.actors.local_actors:JsonLinesActor',
+    'none': 'librarian.actors.local_actors:DummyActor',
+    'print': 'librarian.actors.local_actors:PrinterActor',
+    'image': 'librarian.actors.local_actors:ImageActor',
+})
 
 
 def configure_actor(config):
@@ -31,22 +30,27 @@ def configure_actor(config):
     """
     # No validato used, return just a dummy:
     if len(config) == 0:
-        return local_actors.DummyActor()
+        return actors['none']()
 
     # Single validator
     elif len(config) == 1:
-        config = config[0]
-        tag = config['actor']
-        args = config.get('args',[])
-        kwargs = config.get('kwargs', {})
-        return actors[tag](*args, **kwargs)
+        return _create_actor(config[0])
 
     # Compose a validator using multiple validators:
     else:
-        composite = actor.CompositeActor()
+        from librarian.actors.actor import CompositeActor
+        composite = CompositeActor()
         for c in config:
-            tag = c['actor']
-            args = c.get('args',[])
-            kwargs = c.get('kwargs', {})
-            composite += actors[tag](*args, **kwargs)
-        return composite
\ No newline at end of file
+            composite += _create_actor(c)
+        return composite
+
+
+def _create_actor(config):
+    tag = config['actor']
+    args = config.get('args',[])
+    kwargs = config.get('kwargs', {})
+    instance = actors[tag](*args, **kwargs)
+    # Optional limit for waiting on the actor, in seconds:
+    if config.get('timeout') is not None:
+        instance.timeout = float(config['timeout'])
+    return instance
\ No newline at end of file
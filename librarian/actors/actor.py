@@ -1,18 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+import multiprocessing
+from werkzeug.datastructures import FileStorage
+from librarian import artifacts
+from librarian import profiling
+from librarian.streaming import PipeReader
+import os
+import threading
+import time
+
+
+class SharedExecutor:
+    """ Thread or process pool shared within a process
+
+        The pool is created lazily, and again after a fork, so that
+        instances can be created before gunicorn forks its workers.
+        Process pools spawn their processes, as forking a process with
+        threads running is not safe.
+
+        Args:
+            name (str): Prefix for the thread names
+            env_var (str): Environment variable to read the size from
+            default (int): Size of the pool if env_var is not set
+            processes (bool): Use a process pool instead of threads
+    """
+    def __init__(self, name, env_var, default, processes=False):
+        self.name = name
+        self.env_var = env_var
+        self.default = default
+        self.processes = processes
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.processes:
+                        self._pool = ProcessPoolExecutor(
+                            self.size(),
+                            mp_context=multiprocessing.get_context('spawn')
+                        )
+                    else:
+                        self._pool = ThreadPoolExecutor(
+                            self.size(), thread_name_prefix=self.name
+                        )
+                    self._pid = os.getpid()
+        return self._pool
+
+    def size(self):
+        """ Configured number of workers in the pool """
+        return int(os.environ.get(self.env_var, self.default))
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get().submit(fn, *args, **kwargs)
+
+
+# Runs the actors of a request. Size from ACTOR_THREADS (default 16):
+actor_pool = SharedExecutor('actor', 'ACTOR_THREADS', 16)
+
+
 class Actor:
     """ Base class for Actors. Cannot work by itself
 
     The inheriting classes must implement the __init__ and act()
     methods. The act() method must accept arguments "data" and "uid"
+
+    The "timeout" attribute (seconds) limits how long a request waits for
+    the actor when actors are run concurrently. None waits indefinitely.
+    Actors needing to seek in the data, e.g. to decode a whole image, must
+    set streamable to False, as the 'stream' datatype can only be read
+    forward.
     """
+    timeout = None
+    streamable = True
+
     def __init__(self):
         pass
 
     def act(self, data, uid):
         raise NotImplementedError("Inherited method not implemented")
 
+    def act_many(self, items):
+        """ Act on several objects at once
+
+            Defaults to calling act() for each item. Actors that can do
+            better in bulk should override this.
+
+            Args:
+                items (list): List of (data, uid) tuples
+
+            Returns (list):
+                Responses of the actor, one per item
+        """
+        return [self.act(data, uid) for data, uid in items]
+
+    def query(self, filters=None, fields=None, after=None, limit=100):
+        """ Query the stored objects, newest first
+
+            Actors that can read back what they stored should implement
+            this to serve the /get endpoint.
+
+            Args:
+                filters (dict): Values the fields must equal
+                fields (list): Fields to return. Defaults to all.
+                after (str): Cursor from the previous page, if any
+                limit (int): Maximum number of objects to return
+
+            Returns (dict):
+                "items": the objects, "next": cursor for the next page,
+                None if this was the last one
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support queries"
+        )
+
+    def export(self, filters=None, fields=None, batch_size=1000):
+        """ Iterate over all the stored objects
+
+            Unlike query(), nothing is collected in memory, so any number
+            of objects can be exported.
+
+            Args:
+                filters (dict): Values the fields must equal
+                fields (list): Fields to return. Defaults to all.
+                batch_size (int): Objects to fetch from storage at once
+
+            Returns (iterator):
+                The objects as dicts
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support exports"
+        )
+
+    def fetch(self, uid, labels):
+        """ Read back the data stored for an upload
+
+            Args:
+                uid (str): uid of the upload
+                labels (dict): Labels of the upload
+
+            Returns (tuple):
+                (extension, bytes) of the stored data, None if not found.
+                The extension includes the dot, e.g. ".jpg".
+        """
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support fetching"
+        )
+
+    def stage(self, uid, filename, stream, size, staged):
+        """ Start storing a resumable upload while it is still arriving
+
+            Actors storing data in parts can store the parts complete so
+            far, so that act() only has the rest left once the upload is
+            finalized. Does nothing by default.
+
+            Args:
+                uid (str): uid the upload will have
+                filename (str): Filename of the upload
+                stream (file-like): Seekable stream of the data so far
+                size (int): Bytes of the data so far
+                staged (dict): What the actors have staged so far, saved
+                    with the upload. Updated in place. Passed on to act()
+                    as peek(data, 'staged').
+        """
+        pass
+
+    def discard(self, uid, filename, staged):
+        """ Throw away what stage() stored and act() did not use """
+        pass
+
     def __str__(self):
         string = self.__class__.__name__+':'
         for var, val in vars(self).items():
+            # Skip internal state, e.g. locks and caches:
+            if var.startswith('_'):
+                continue
             string += f"\n\t{var}: {val}"
         return string
 
@@ -27,10 +191,11 @@ class Actor:
 class CompositeActor:
     """ Compose a combination of several actors
 
-        Checks the object agains every actors
+        Runs every actor on the object concurrently. Each actor gets its
+        own copy of the labels or its own view of the data stream.
 
         Args:
-            *validators: actors to compose the actor from
+            *actors: actors to compose the actor from
     """
     def __init__(self, *actors):
         self.actors = list(actors) if actors is not None else []
@@ -45,8 +210,60 @@ class CompositeActor:
         else:
             return self.__add__(other)
 
-    def __call__(self, obj):
-        return [actor.act(obj) for actor in self.actors]
+    def __call__(self, data, uid):
+        return self.act(data, uid)
+
+    def act(self, data, uid):
+        """ Act with every actor. Raises the first error, if any """
+        return _raise_first(run_actors([(self, data, uid)])[0])
+
+    def act_many(self, items):
+        return _raise_first(run_actors([(self, items, None)], many=True)[0])
+
+    def query(self, *args, **kwargs):
+        """ Query the first actor that supports queries """
+        for actor in self.leaves():
+            try:
+                return actor.query(*args, **kwargs)
+            except NotImplementedError:
+                continue
+        raise NotImplementedError("No actor supports queries")
+
+    def export(self, *args, **kwargs):
+        """ Export from the first actor that supports exports """
+        for actor in self.leaves():
+            try:
+                return actor.export(*args, **kwargs)
+            except NotImplementedError:
+                continue
+        raise NotImplementedError("No actor supports exports")
+
+    def fetch(self, uid, labels):
+        """ Fetch from the first actor having the data """
+        supported = False
+        for actor in self.leaves():
+            try:
+                found = actor.fetch(uid, labels)
+            except NotImplementedError:
+                continue
+            supported = True
+            if found is not None:
+                return found
+        if not supported:
+            raise NotImplementedError("No actor supports fetching")
+        return None
+
+    def stage(self, *args):
+        for actor in self.leaves():
+            actor.stage(*args)
+
+    def discard(self, *args):
+        for actor in self.leaves():
+            actor.discard(*args)
+
+    def leaves(self):
+        """ The non-composite actors this actor is made of """
+        return [leaf for actor in self.actors for leaf in _leaves(actor)]
 
     def __str__(self):
         string = self.__class__.__name__ +" with Actors:"
@@ -56,3 +273,239 @@ class CompositeActor:
 
     def __repr__(self):
         return str(self).replace('\n', ', ').replace('\t', '').strip()
+
+
+class ActorResult:
+    """ Outcome of running a single actor
+
+        Args:
+            actor (Actor): The actor that was run
+            response: What the actor returned, None on error
+            error (Exception): What the actor raised, None on success
+            seconds (float): Time the actor took
+    """
+    def __init__(self, actor, response=None, error=None, seconds=None):
+        self.actor = actor
+        self.response = response
+        self.error = error
+        self.seconds = seconds
+
+    def __repr__(self):
+        name = self.actor.__class__.__name__
+        if self.error is not None:
+            return f"{name}: error: {self.error}"
+        return f"{name}: {self.response}"
+
+
+def run_actors(jobs, many=False, feed=None):
+    """ Run actors concurrently on the shared actor pool
+
+        Composite actors are expanded into the actors they are made of,
+        so the pool threads never wait for each other. The caller waits
+        at most actor.timeout seconds for each actor. A timed out actor
+        is reported as an error, but cannot be stopped and finishes in
+        the background. Its view of the data is cut off, so its next read
+        fails instead of reading a file the caller has closed, and what
+        it has written so far may be left partial.
+
+        Args:
+            jobs (list): (actor, data, uid) tuples. With many=True, data
+                is the list of (data, uid) items and uid is ignored.
+            many (bool): Call act_many() instead of act()
+            feed (function): Called in this thread once the actors are
+                running, e.g. to write the Pipe their data streams from
+
+        Returns (list):
+            For every job, a list of ActorResults of its non-composite
+            actors
+    """
+    calls = []
+    sizes = []
+    for actor, data, uid in jobs:
+        leaves = _leaves(actor)
+        sizes.append(len(leaves))
+        if many:
+            copies = zip(*[_fork(d, len(leaves)) for d, _ in data]) \
+                if data else [[]] * len(leaves)
+            for leaf, datas in zip(leaves, copies):
+                items = [(d, u) for d, (_, u) in zip(datas, data)]
+                calls.append((leaf, leaf.act_many, (items,)))
+        else:
+            for leaf, d in zip(leaves, _fork(data, len(leaves))):
+                calls.append((leaf, leaf.act, (d, uid)))
+
+    # Profile the actors too if the caller is being profiled:
+    session = profiling.current()
+    start = time.monotonic()
+    futures = [actor_pool.submit(_timed, actor, fn, args, session)
+               for actor, fn, args in calls]
+    if feed is not None:
+        feed()
+    results = []
+    for (actor, _, args), future in zip(calls, futures):
+        timeout = None
+        if actor.timeout is not None:
+            timeout = max(start + float(actor.timeout) - time.monotonic(), 0)
+        try:
+            results.append(future.result(timeout))
+        except TimeoutError:
+            _abandon(args)
+            results.append(ActorResult(actor, error=TimeoutError(
+                f"{actor.__class__.__name__} timed out after {actor.timeout}s"
+            ), seconds=time.monotonic() - start))
+
+    grouped = []
+    for size in sizes:
+        grouped.append(results[:size])
+        results = results[size:]
+    return grouped
+
+
+def _timed(actor, fn, args, session=None):
+    profile = None
+    if session is not None:
+        try:
+            profile = session.enable()
+        except ValueError: # Another profiler is running
+            pass
+    start = time.perf_counter()
+    try:
+        response = fn(*args)
+    except Exception as e:
+        return ActorResult(actor, error=e,
+                           seconds=time.perf_counter() - start)
+    finally:
+        if profile is not None:
+            profile.disable()
+        # Don't let a streamed upload wait for an actor that is done:
+        for arg in args:
+            if isinstance(getattr(arg, 'stream', None), PipeReader):
+                arg.stream.close()
+    return ActorResult(actor, response, seconds=time.perf_counter() - start)
+
+
+def _abandon(args):
+    """ Cut off the views of the data of an actor left running """
+    for arg in args:
+        items = arg if isinstance(arg, list) else [(arg, None)]
+        for data, _ in items:
+            if isinstance(getattr(data, 'stream', None), StreamView):
+                data.stream.abandon()
+
+
+def _raise_first(results):
+    for result in results:
+        if result.error is not None:
+            raise result.error
+    return [result.response for result in results]
+
+
+def _leaves(actor):
+    if isinstance(actor, CompositeActor):
+        return actor.leaves()
+    return [actor]
+
+
+def _fork(data, n):
+    """ Give n concurrent actors their own copies of the data
+
+        Dicts (labels) are copied, since actors add keys to them. Files
+        get independent views of the same stream instead of copies, and
+        streamed uploads a reader of the pipe each. A single actor gets a
+        view of a file too, to be cut off if it times out.
+    """
+    if n == 1 and not isinstance(data, FileStorage):
+        return [data]
+    if isinstance(data, dict):
+        return [dict(data) for _ in range(n)]
+    if isinstance(data, FileStorage) and isinstance(data.stream, PipeReader):
+        # Streamed from the request, every actor reads its own copy:
+        return [data] + [
+            FileStorage(stream=data.stream.pipe.reader(),
+                        filename=data.filename, name=data.name,
+                        headers=data.headers)
+            for _ in range(n-1)
+        ]
+    if isinstance(data, FileStorage):
+        lock = threading.Lock()
+        views = [
+            FileStorage(
+                stream=StreamView(data.stream, lock), filename=data.filename,
+                name=data.name, headers=data.headers
+            )
+            for _ in range(n)
+        ]
+        # Share what was already decoded from the data:
+        for view in views:
+            artifacts.share(data, view)
+        return views
+    return [data] * n
+
+
+class StreamView:
+    """ Read-only view of a seekable stream with its own position
+
+        Several views can read the same stream from different threads, as
+        long as they share the lock. An abandoned view raises ValueError
+        on reading, e.g. once its actor timed out and the stream may be
+        closed.
+
+        Args:
+            stream (file-like): Seekable stream to read
+            lock (threading.Lock): Lock shared by all views of the stream
+    """
+    def __init__(self, stream, lock):
+        self.stream = stream
+        self.lock = lock
+        self.pos = 0
+        self.abandoned = False
+
+    def abandon(self):
+        """ Stop reading, the stream is no longer touched once returned """
+        with self.lock:
+            self.abandoned = True
+
+    def _check(self):
+        if self.abandoned:
+            raise ValueError("Stream abandoned, the actor timed out")
+
+    def read(self, size=-1):
+        with self.lock:
+            self._check()
+            self.stream.seek(self.pos)
+            chunk = self.stream.read(size)
+        self.pos += len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        with self.lock:
+            self._check()
+            self.stream.seek(self.pos)
+            line = self.stream.readline(size)
+        self.pos += len(line)
+        return line
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            with self.lock:
+                self._check()
+                offset += self.stream.seek(0, os.SEEK_END)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.readline, b'')
@@ -0,0 +1,4 @@
+class ActorBusyError(Exception):
+    """ Raised when an actor cannot take more work right now """
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args, **kwargs)
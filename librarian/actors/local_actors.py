@@ -1,7 +1,14 @@
-from librarian.actors.actor import Actor
+from librarian.actors.actor import Actor, SharedExecutor
+from librarian.artifacts import image_info, peek
+from io import BytesIO
 import json
-from PIL import Image
 import os
+import shutil
+import threading
+try:
+    import fcntl
+except ImportError: # Not available on windows
+    fcntl = None
 
 
 class PrinterActor(Actor):
@@ -24,6 +31,11 @@ class PrinterActor(Actor):
 class FileActor(Actor):
     """ Saves the given data objects as a file
 
+        The files are named by the uid and the extension of the upload,
+        so uploads of the same name do not overwrite each other. The
+        stored and the uploaded names of every uid are appended to ".uids"
+        in the directory.
+
         Args:
             directory (str): Directory to which the files are saved. Will
                 be created if doesn't exist
@@ -34,6 +46,9 @@ class FileActor(Actor):
         super().__init__()
         self.description = "Saves object to a local file"
         self.directory = directory
+        self.index = os.path.join(directory, '.uids')
+        self._filenames = None
+        self._lock = threading.Lock()
         if not os.path.isdir(directory):
             os.makedirs(directory)
 
@@ -41,27 +56,146 @@ class FileActor(Actor):
         """ Saves the data into the supplied directory """
         #with open(os.path.join(self.directory, data.filename), 'w') as f:
         #    f.write(data)
-        data.save(os.path.join(self.directory, data.filename))
+        # Validators may have read the stream already:
+        data.stream.seek(0)
+        stored = uid + os.path.splitext(data.filename or '')[1]
+        data.save(os.path.join(self.directory, stored))
+        line = json.dumps(
+            {'uid': uid, 'file': stored, 'filename': data.filename}
+        ) + '\n'
+        with self._lock, open(self.index, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
         return "File saved succesfully"
 
+    def fetch(self, uid, labels):
+        """ Read back a file by the name it was stored with
+
+            Files stored by their upload names before the index existed
+            are looked up by the filename label instead.
+        """
+        with self._lock:
+            if self._filenames is None:
+                self._filenames = self._read_index()
+        filename = self._filenames.get(uid) or labels.get('filename')
+        if not filename:
+            return None
+        return _read_file(os.path.join(self.directory, filename))
+
+    def _read_index(self):
+        """ Map uids to the names their files were stored with """
+        filenames = {}
+        try:
+            with open(self.index) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A write cut short
+                        continue
+                    # Older entries stored the file by its upload name:
+                    filenames[entry['uid']] = entry.get('file',
+                                                        entry['filename'])
+        except FileNotFoundError:
+            pass
+        return filenames
+
 
 class ImageActor(Actor):
     """ Saves object to a local image file
 
+        Images already in the target format are saved as they are. Others
+        are transcoded in the request thread, or in a pool of processes if
+        the environment variable IMAGE_PROCESSES is set. The pool is shared
+        by the threads of a process, so every web worker starts that many.
+
         Args:
             directory (str): Directory to which the files are saved. Will
                 be created if doesn't exist
+            format (str): Pillow format to save the images as
+            quality (int): Quality of lossy formats, 1-95
+            progressive (bool): Save progressive JPEGs
+            optimize (bool): Spend more time to make the files smaller
     """
-    def __init__(self, directory):
+    # Decodes the whole image:
+    streamable = False
+
+    def __init__(self, directory, format='JPEG', quality=90,
+                 progressive=False, optimize=False):
         super().__init__()
         self.description = "Saves object ot a local image file"
         self.directory = directory
+        self.format = format.upper()
+        self.extension = IMAGE_EXTENSIONS.get(self.format, self.format.lower())
+        self.params = {
+            'quality': int(quality),
+            'progressive': bool(progressive),
+            'optimize': bool(optimize),
+        }
         if not os.path.isdir(directory):
             os.makedirs(directory)
 
     def act(self, data, uid):
-        im = Image.open(data)
-        im.save(os.path.join(self.directory, uid+'.jpg'))
+        path = os.path.join(self.directory, uid+'.'+self.extension)
+
+        if image_info(data)['format'] == self.format:
+            # Nothing to convert, keep the original bytes:
+            data.stream.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(data.stream, f)
+            return "Image saved succesfully"
+
+        # Send the decoded image if it is already at hand, else the file:
+        im = peek(data, 'image')
+        if im is None:
+            data.stream.seek(0)
+            im = data.stream.read()
+
+        if image_pool.size() > 0:
+            image_pool.submit(
+                transcode_image, im, path, self.format, self.params
+            ).result()
+        else:
+            transcode_image(im, path, self.format, self.params)
+        return "Image transcoded and saved succesfully"
+
+    def fetch(self, uid, labels):
+        return _read_file(os.path.join(self.directory, uid+'.'+self.extension))
+
+
+def _read_file(path):
+    """ (extension, contents) of a file, None if it doesn't exist """
+    try:
+        with open(path, 'rb') as f:
+            return os.path.splitext(path)[1], f.read()
+    except FileNotFoundError:
+        return None
+
+
+# File extensions of the formats, others use the lower case format:
+IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'TIFF': 'tif'}
+
+# Processes to transcode images in, none unless asked for:
+image_pool = SharedExecutor('image', 'IMAGE_PROCESSES', 0, processes=True)
+
+
+def transcode_image(im, path, format, params):
+    """ Save an image in another format. Runs in the image processes.
+
+        Args:
+            im (PIL.Image.Image or bytes): Decoded image or the image file
+            path (str): File to save to
+            format (str): Pillow format to save as
+            params (dict): Options for the format, e.g. quality
+    """
+    from PIL import Image
+    if isinstance(im, bytes):
+        im = Image.open(BytesIO(im))
+    # JPEG has no alpha or palettes:
+    if format == 'JPEG' and im.mode not in ('RGB', 'L', 'CMYK'):
+        im = im.convert('RGB')
+    im.save(path, format, **params)
 
 
 class JsonActor(Actor):
@@ -78,9 +212,22 @@ class JsonActor(Actor):
 
     def act(self, data, uid):
         """ Saves the data to specified json file by appending """
-        # Save as a list of objects:
         data["uid"] = uid
-        data = [data]
+        return self._save([data])
+
+    def act_many(self, items):
+        """ Saves all the items with a single rewrite of the json file """
+        records = []
+        for data, uid in items:
+            data["uid"] = uid
+            records.append(data)
+        # Newest first, as with single saves:
+        msg = self._save(records[::-1])
+        return [msg] * len(records)
+
+    def _save(self, records):
+        # Save as a list of objects:
+        data = list(records)
         if os.path.exists(self.jsonfile):
             with open(self.jsonfile, 'r') as f:
                 data += json.load(f)
@@ -91,6 +238,181 @@ class JsonActor(Actor):
         return "Json saved successfully"
 
 
+class JsonLinesActor(Actor):
+    """ Appends objects to a local json lines file, one record per line
+
+        Writes take constant time regardless of the size of the file.
+        A sidecar index file ("<jsonfile>.idx") maps uids to the byte
+        offsets of their records for fast lookups with get().
+        Use "librarian_cli.py compact" to convert old json files or to
+        clean up the file offline.
+
+        Args:
+            jsonfile (str): json lines file to which save the data. If a
+                path, the directory should already exist!
+            fsync (bool): Force each write to disk before returning
+    """
+    def __init__(self, jsonfile, fsync=False):
+        super().__init__()
+        self.description = "Appends object to a local json lines file"
+        self.jsonfile = jsonfile
+        self.indexfile = jsonfile + '.idx'
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._offsets = _load_offsets(self.indexfile)
+
+    def act(self, data, uid):
+        """ Appends the data to the json lines file """
+        data["uid"] = uid
+        self._append([data])
+        return "Json line saved successfully"
+
+    def act_many(self, items):
+        records = []
+        for data, uid in items:
+            data["uid"] = uid
+            records.append(data)
+        self._append(records)
+        return ["Json line saved successfully"] * len(records)
+
+    def get(self, uid):
+        """ Read a single record by its uid
+
+            Args:
+                uid (str): uid of the record
+
+            Returns (dict):
+                The record, or None if no such uid is stored
+        """
+        offset = self._offsets.get(uid)
+        if offset is None:
+            # Might have been written by another process:
+            self._offsets = _load_offsets(self.indexfile)
+            offset = self._offsets.get(uid)
+            if offset is None:
+                return None
+        with open(self.jsonfile, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def export(self, filters=None, fields=None, batch_size=1000):
+        """ Iterate over the records, in the order they were saved
+
+            Args:
+                filters (dict): Values the fields must equal
+                fields (list): Fields to return. Defaults to all.
+                batch_size (int): Not used, lines are read one by one
+
+            Returns (iterator):
+                The records
+        """
+        filters = filters or {}
+        with open(self.jsonfile, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # E.g. a write cut short by a crash:
+                    continue
+                if any(record.get(k) != v for k, v in filters.items()):
+                    continue
+                if fields:
+                    record = {k: record[k] for k in fields if k in record}
+                yield record
+
+    def _append(self, records):
+        lines = [json.dumps(r).encode() + b'\n' for r in records]
+        with self._lock, open(self.jsonfile, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            offset = f.seek(0, os.SEEK_END)
+            # Start on a new line if a previous write was cut short:
+            if offset > 0:
+                f.seek(offset - 1)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+                    offset += 1
+            f.write(b''.join(lines))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+            index = []
+            for record, line in zip(records, lines):
+                index.append(f"{record['uid']} {offset}\n")
+                self._offsets[record['uid']] = offset
+                offset += len(line)
+            with open(self.indexfile, 'a') as idx:
+                idx.write(''.join(index))
+            # Lock is released on close
+
+
+def _load_offsets(indexfile):
+    """ Read a uid -> byte offset index, skipping broken lines """
+    offsets = {}
+    if not os.path.exists(indexfile):
+        return offsets
+    with open(indexfile, 'r') as f:
+        for line in f:
+            try:
+                uid, offset = line.split()
+                offsets[uid] = int(offset)
+            except ValueError:
+                continue
+    return offsets
+
+
+def compact_json_lines(src, dst=None):
+    """ Rewrite a json or json lines file as a clean json lines file
+
+        Old json files (a list of records, newest first) are converted to
+        json lines in the order they were saved. Broken lines, e.g. from
+        a crash during a write, are dropped and for duplicate uids only
+        the last record is kept. The offset index is rebuilt.
+
+        Args:
+            src (str): json or json lines file to read
+            dst (str): json lines file to write. Defaults to src, which is
+                then replaced in place.
+
+        Returns (int):
+            Number of records written
+    """
+    dst = dst or src
+    with open(src, 'rb') as f:
+        head = f.read(64).lstrip()
+        f.seek(0)
+        if head.startswith(b'['):
+            records = json.load(f)[::-1]
+        else:
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+    # Keep the last record of each uid:
+    latest = {}
+    for i, record in enumerate(records):
+        latest[record.get('uid', i)] = record
+
+    tmp, tmp_idx = dst + '.tmp', dst + '.idx.tmp'
+    offset = 0
+    with open(tmp, 'wb') as f, open(tmp_idx, 'w') as idx:
+        for uid, record in latest.items():
+            line = json.dumps(record).encode() + b'\n'
+            f.write(line)
+            if 'uid' in record:
+                idx.write(f"{uid} {offset}\n")
+            offset += len(line)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, dst)
+    os.replace(tmp_idx, dst + '.idx')
+    return len(latest)
+
+
 class DummyActor(Actor):
     """ A dummy actor: does nothing, i.e. passes everything.
 
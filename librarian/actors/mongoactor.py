@@ -1,7 +1,16 @@
-from pymongo import MongoClient
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
+import atexit
+import json
 import os
+import queue
+import sys
+import threading
+import time
 from librarian.actors.actor import Actor
+from librarian.actors.exceptions import ActorBusyError
+from librarian.cache import QueryCache
+from librarian.clients import mongo_client
 
 
 class MongoActor(Actor):
@@ -17,23 +26,74 @@ class MongoActor(Actor):
             url (str): mongoDB connection url
             db (str): mongoDB database name to which data is uploaded
             col (str): mongoDB collection name to which data is uploaded
+            buffer_size (int): Enables write-behind buffering when > 0.
+                Records are queued (at most buffer_size of them) and
+                inserted in bulk by a background thread.
+            flush_size (int): Insert once this many records are queued
+            flush_interval (float): Insert at latest after this many
+                seconds, even if flush_size is not reached
+            put_timeout (float): Seconds to wait for room in a full buffer
+                before giving up with ActorBusyError. 0 to fail at once.
+            cache_size (int): Number of query results to cache. 0 disables
+                the cache.
+            cache_ttl (float): Seconds a cached query result is valid.
+                Writes of this process clear the cache at once, writes of
+                other processes are seen after this.
+            pool_size (int): Maximum connections of the process to the
+                database. The client, and so the connections, are shared
+                with the other actors connecting with the same arguments.
+
+        NOTE: In buffered mode the request is answered before the records
+        are stored, so insert failures are only logged.
     """
-    def __init__(self, usr, pwd, url, db, col):
+    def __init__(self, usr, pwd, url, db, col, buffer_size=0,
+                 flush_size=500, flush_interval=0.5, put_timeout=1.0,
+                 cache_size=256, cache_ttl=10, pool_size=100):
         super().__init__()
         self.description = "Uploads data to mongoDB"
-        # Create mLab string:
-        mongo_str =  f'mongodb://{usr}:{pwd}@{url}/{db}'
-        mongo_str += '?retrywrites=false'
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.buffer_size = int(buffer_size)
+        self._buffer = None
+        if self.buffer_size > 0:
+            self._buffer = _WriteBehind(
+                self.put_many, self.buffer_size, int(flush_size),
+                float(flush_interval), float(put_timeout)
+            )
+            atexit.register(self.close)
+        # The shared client is created on first use, after any fork:
+        self._connection = (usr, pwd, url, db, pool_size)
+        self._client = None
+        self.db_name = db
+        self.col_name = col
 
-        # Set up the general client:
-        self.client = MongoClient(mongo_str)
-        self.db = self.client[db]
-        self.col = self.db[col]
+    @property
+    def col(self):
+        client = mongo_client(*self._connection)
+        if client is not self._client:
+            self._col = client[self.db_name][self.col_name]
+            self._client = client
+        return self._col
 
     def act(self, data, uid):
         data["uid"] = uid
+        if self._buffer is not None:
+            return self._buffer.put([data])
         return self.put_one(data)
 
+    def act_many(self, items):
+        docs = []
+        for data, uid in items:
+            data["uid"] = uid
+            docs.append(data)
+        if self._buffer is not None:
+            return self._buffer.put(docs)
+        return self.put_many(docs)
+
+    def close(self):
+        """ Insert all the buffered records and stop the flusher """
+        if self._buffer is not None:
+            self._buffer.close()
+
     def put_one(self, data):
         """ Insert data to collection.
 
@@ -57,8 +117,99 @@ class MongoActor(Actor):
 
         # Insert to the collection:
         result = self.col.insert_one(data)
+        self.cache.clear()
         return result
 
+    def put_many(self, docs):
+        """ Insert several documents to collection with one request.
+
+            Args:
+                docs (list of dicts): Documents to insert
+
+            Return (InsertManyResult):
+                Result of the insert, empty list if nothing to insert
+        """
+        assert all(isinstance(d, dict) for d in docs), \
+            "MongoActor: Data was not a dict"
+
+        if not docs:
+            return []
+
+        try:
+            return self.col.insert_many(docs, ordered=False)
+        finally:
+            # Even failed bulk inserts may have inserted some:
+            self.cache.clear()
+
+    def query(self, filters=None, fields=None, after=None, limit=100):
+        """ Query documents, newest first, a page at a time
+
+            Pages are fetched by _id, not by skipping, so fetching deep
+            pages is as fast as the first one. The results are cached.
+
+            Args:
+                filters (dict): Values the label fields must equal
+                fields (list): Fields to return. Defaults to all but _id.
+                after (str): Cursor from the previous page, if any
+                limit (int): Maximum number of documents to return
+
+            Returns (dict):
+                "items": the documents, "next": cursor for the next page,
+                None if this was the last one
+
+            Raises:
+                ValueError: on an invalid cursor
+        """
+        key = json.dumps([filters, fields, after, limit], sort_keys=True)
+        page = self.cache.get(key)
+        if page is not None:
+            return page
+        generation = self.cache.generation
+
+        q = dict(filters or {})
+        if after:
+            try:
+                q['_id'] = {'$lt': ObjectId(after)}
+            except (InvalidId, TypeError):
+                raise ValueError(f"Invalid cursor: {after}")
+        projection = None
+        if fields:
+            projection = dict.fromkeys(fields, 1)
+            projection['_id'] = 1
+
+        docs = list(self.col.find(q, projection)
+                        .sort([('_id', -1)]).limit(limit))
+        cursor = str(docs[-1]['_id']) if len(docs) == limit else None
+        for doc in docs:
+            if fields and '_id' in fields:
+                doc['_id'] = str(doc['_id'])
+            else:
+                del doc['_id']
+
+        page = {'items': docs, 'next': cursor}
+        self.cache.put(key, page, generation)
+        return page
+
+    def export(self, filters=None, fields=None, batch_size=1000):
+        """ Iterate over the documents from a server side cursor
+
+            Args:
+                filters (dict): Values the label fields must equal
+                fields (list): Fields to return. Defaults to all but _id.
+                batch_size (int): Documents fetched per round trip
+
+            Returns (iterator):
+                The documents, in the order they are stored
+        """
+        projection = dict.fromkeys(fields, 1) if fields else None
+        if not fields or '_id' not in fields:
+            projection = projection or {}
+            projection['_id'] = 0
+        docs = self.col.find(
+            dict(filters or {}), projection, batch_size=int(batch_size)
+        )
+        return _stringify_ids(docs)
+
     def get_latest_data(self, q={}, n=1):
         """ Query the database and return the n latest documents
 
@@ -96,9 +247,108 @@ class MongoActor(Actor):
         """
         docs = self.col.find(q).sort([('_id', -1)]).limit(n)
 
+        ret = []
         for d in docs:
             d['_id'] = str(d['_id'])
             ret.append(d)
 
         return ret
 
+
+def _stringify_ids(docs):
+    with docs:
+        for doc in docs:
+            if '_id' in doc:
+                doc['_id'] = str(doc['_id'])
+            yield doc
+
+
+class _WriteBehind:
+    """ Bounded queue drained in batches by a background thread
+
+        The thread and queue are created lazily on first use, and again
+        after a fork, so instances can be created before gunicorn forks.
+        A thread that has died is restarted on the next put, keeping what
+        is queued. Room is reserved for all the records of a put at once,
+        so a put is queued either whole or not at all.
+    """
+    def __init__(self, write, maxsize, flush_size, flush_interval,
+                 put_timeout):
+        self.write = write
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                # Records queued or being written, guarded by _room:
+                self._pending = 0
+                self._room = threading.Condition()
+                self._stop = threading.Event()
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def put(self, docs):
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._start()
+        docs = list(docs)
+        with self._room:
+            # A put larger than the buffer gets in when it is empty:
+            fits = lambda: (self._pending == 0 or
+                            self._pending + len(docs) <= self.maxsize)
+            if not self._room.wait_for(fits, timeout=self.put_timeout):
+                raise ActorBusyError("MongoActor: write buffer is full")
+            self._pending += len(docs)
+        self._queue.put(docs)
+        return f"Queued {len(docs)} record(s) for insert"
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._pid = None
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                self.write(batch)
+            except Exception as e:
+                # E.g. a record bson cannot encode. Drop the batch only:
+                print(f"[MONGO BUFFER ERROR]: {len(batch)} record(s):",
+                      repr(e), file=sys.stderr)
+            finally:
+                with self._room:
+                    self._pending -= len(batch)
+                    self._room.notify_all()
+
+    def _collect(self):
+        """ Wait for a full batch, the flush interval or a stop request """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self._stop.is_set():
+                # Drain without waiting:
+                try:
+                    batch.extend(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.extend(self._queue.get(timeout=min(timeout, 0.1)))
+            except queue.Empty:
+                continue
+        return batch
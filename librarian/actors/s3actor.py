@@ -1,5 +1,15 @@
-import boto3
-from librarian.actors.actor import Actor
+from concurrent.futures import wait
+import threading
+from librarian.actors.actor import Actor, SharedExecutor
+from librarian.artifacts import peek
+from librarian.clients import s3_client
+
+
+# Smallest part size S3 accepts for all but the last part:
+MIN_PART_SIZE = 5 * 1024**2
+
+# Shared by all the uploads of the process. Size from S3_TRANSFER_THREADS:
+transfer_pool = SharedExecutor('s3-transfer', 'S3_TRANSFER_THREADS', 16)
 
 
 class S3Actor(Actor):
@@ -9,24 +19,40 @@ class S3Actor(Actor):
             bucket_name (str): Bucket to which upload the files
             prefix (str): prefix added to the filename
             suffix (str): suffix added to the filename
+            part_size (int): Bodies larger than this (in bytes) are
+                uploaded as a multipart upload of parts of this size.
+                At least 5 MiB.
+            concurrency (int): Maximum number of parts of one upload
+                in flight at once
+            endpoint_url (str): Use another S3 compatible service, e.g.
+                a local minio or moto server for testing
+            pool_size (int): Maximum connections of the process to S3.
+                The client, and so the connections, are shared with the
+                other actors connecting with the same arguments.
     """
-    def __init__(self, acess_key, secret_key, bucket_name, prefix="", suffix=""):
+    def __init__(self, acess_key, secret_key, bucket_name, prefix="", suffix="",
+                 part_size=8*1024**2, concurrency=4, endpoint_url=None,
+                 pool_size=16):
         super().__init__()
         self.description = "Uploads the data to S3 storage as a file"
         self.bucket_name = bucket_name
         self.prefix = prefix
         self.suffix = suffix
-        # Let's use Amazon S3
-        self.s3 = boto3.resource(
-            's3', aws_access_key_id=acess_key,
-            aws_secret_access_key=secret_key
-        )
-        self.bucket = self.s3.Bucket(bucket_name)
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.concurrency = max(int(concurrency), 1)
+        # Let's use Amazon S3, with a client shared and created on use:
+        self._connection = (acess_key, secret_key, endpoint_url, pool_size)
+        self._keys = None
+        self._keys_lock = threading.Lock()
+
+    @property
+    def client(self):
+        return s3_client(*self._connection)
 
     def print_buckets(self):
         # Print out bucket names
-        for bucket in self.s3.buckets.all():
-            print(bucket.name)
+        for bucket in self.client.list_buckets()['Buckets']:
+            print(bucket['Name'])
 
     def upload_image(self, key, data):
         # Upload a new file
@@ -34,20 +60,162 @@ class S3Actor(Actor):
         pass
 
     def act(self, data, uid):
-        # Try to get the extension:
-        ext = ''
+        # TODO: check for file conversion need
+        key = self._key(uid, data.filename or data.name)
+        # Parts of a resumable upload stored before it was finalized:
+        staged = peek(data, 'staged')
+        state = staged.pop(self._staged_id(key), None) if staged else None
+        if state is not None:
+            data.stream.seek(len(state['parts']) * self.part_size)
+            first = data.stream.read(self.part_size)
+            parts = self._upload_parts(key, first, data.stream,
+                                       state['upload_id'], state['parts'])
+            return f"Uploaded {key} in {parts} parts"
+        data.stream.seek(0)
+        return self.upload(key, data.stream)
 
-        # So ugly:
-        try:
-            ext = '.'+data.filename.split('.')[-1]
-        except AttributeError as e:
-            print("Extension exception from 'filename':", str(e))
+    def stage(self, uid, filename, stream, size, staged):
+        """ Upload the complete parts of a resumable upload """
+        key = self._key(uid, filename)
+        state = staged.get(self._staged_id(key))
+        if state is None:
+            state = {'upload_id': None, 'parts': []}
+        while size - len(state['parts']) * self.part_size >= self.part_size:
+            if state['upload_id'] is None:
+                state['upload_id'] = self.client.create_multipart_upload(
+                    Bucket=self.bucket_name, Key=key
+                )['UploadId']
+                staged[self._staged_id(key)] = state
+            number = len(state['parts']) + 1
+            stream.seek((number-1) * self.part_size)
+            state['parts'].append(self.client.upload_part(
+                Bucket=self.bucket_name, Key=key, UploadId=state['upload_id'],
+                PartNumber=number, Body=stream.read(self.part_size)
+            )['ETag'])
+
+    def discard(self, uid, filename, staged):
+        key = self._key(uid, filename)
+        state = staged.pop(self._staged_id(key), None)
+        if state is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=state['upload_id']
+            )
+
+    def _key(self, uid, filename):
+        ext = '.'+filename.split('.')[-1] if filename else ''
+        return self.prefix+uid+ext+self.suffix
+
+    def _staged_id(self, key):
+        return f"s3://{self.bucket_name}/{key}"
+
+    def fetch(self, uid, labels):
+        """ Download the object of an upload
+
+            The keys have the extension of the uploaded file, which is
+            not known from the uid. All the keys under the prefix are thus
+            listed once, and the objects found by uid from that listing.
+        """
+        with self._keys_lock:
+            if self._keys is None:
+                self._keys = self._list_keys()
+        key = self._keys.get(uid)
+        if key is None:
+            return None
+        body = self.client.get_object(
+            Bucket=self.bucket_name, Key=key
+        )['Body'].read()
+        name = key[len(self.prefix):len(key)-len(self.suffix)]
+        return name[len(uid):], body
+
+    def _list_keys(self):
+        """ Map uids to the keys under the prefix """
+        keys = {}
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket_name, Prefix=self.prefix
+        )
+        for page in pages:
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if self.suffix and not key.endswith(self.suffix):
+                    continue
+                name = key[len(self.prefix):len(key)-len(self.suffix)]
+                keys[name.split('.')[0]] = key
+        return keys
+
+    def upload(self, key, stream):
+        """ Upload a stream, in parallel parts if it is large
+
+            Args:
+                key (str): Key of the uploaded object
+                stream (file-like): Stream to read the body from
+
+            Returns (str):
+                Description of the upload
+        """
+        first = stream.read(self.part_size)
+        if len(first) < self.part_size:
+            self.client.put_object(Bucket=self.bucket_name, Key=key,
+                                   Body=first)
+            return f"Uploaded {key}"
+        parts = self._upload_parts(key, first, stream)
+        return f"Uploaded {key} in {parts} parts"
+
+    def _upload_parts(self, key, first, stream, upload_id=None, done=()):
+        """ Upload the stream as parts, continuing after the parts done
+            if upload_id is given. Returns the number of parts.
+
+            Stops reading the stream at the first part failing, and
+            aborts the upload once the parts in flight have finished.
+        """
+        client = self.client
+        if upload_id is None:
+            upload_id = client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=key
+            )['UploadId']
+
+        # Limit the parts in flight, which also bounds the memory used:
+        slots = threading.BoundedSemaphore(self.concurrency)
+        errors = []
+
+        def upload_part(number, chunk):
             try:
-                ext = '.'+data.name.split('.')[-1]
-            except AttributeError as e:
-                print("Extension exception from 'name':", str(e))
+                return client.upload_part(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=chunk
+                )['ETag']
+            except Exception as e:
+                errors.append(e)
+                raise
+            finally:
+                slots.release()
 
-        # TODO: check for file conversion need
-        data.stream.seek(0)
-        key = self.prefix+uid+ext+self.suffix
-        self.bucket.put_object(Key=key, Body=data.stream)
\ No newline at end of file
+        futures = []
+        try:
+            chunk = first
+            while chunk:
+                slots.acquire()
+                if errors:
+                    # No use reading the rest of the body:
+                    raise errors[0]
+                futures.append(transfer_pool.submit(
+                    upload_part, len(done)+len(futures)+1, chunk
+                ))
+                chunk = stream.read(self.part_size)
+
+            etags = list(done) + [f.result() for f in futures]
+            parts = [{'PartNumber': i+1, 'ETag': etag}
+                     for i, etag in enumerate(etags)]
+            client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            for f in futures:
+                f.cancel()
+            # Parts finishing after the abort would be stored again:
+            wait(futures)
+            client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id
+            )
+            raise
+        return len(parts)
\ No newline at end of file
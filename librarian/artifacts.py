@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+
+
+# Bytes read at a time when hashing:
+HASH_CHUNK = 1024 * 1024
+
+
+class Artifacts(dict):
+    """ Facts computed from one uploaded data object
+
+        Attached to the data object itself, so it lives as long as the
+        request does and is shared by every validator and actor handling
+        the data. Values are computed lazily, once, under the lock.
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+
+
+def image_info(data):
+    """ Header facts of an image, without decoding it
+
+        Args:
+            data (FileStorage): The image file
+
+        Returns (dict):
+            The "format", "width", "height" and "mode" of the image
+
+        Raises:
+            Whatever Pillow raises if the file is not an image
+    """
+    cache = _cache_of(data)
+    if cache is not None and 'image' in cache:
+        return _info(cache['image'])
+    return cached(data, 'image_info', _read_image_info)
+
+
+def decoded_image(data):
+    """ The fully decoded image
+
+        Also checks the image can actually be decoded, e.g. that it is
+        not truncated.
+
+        Args:
+            data (FileStorage): The image file
+
+        Returns (PIL.Image.Image):
+            The decoded image. Must not be modified, it is shared.
+
+        Raises:
+            Whatever Pillow raises if the file is not a valid image
+    """
+    return cached(data, 'image', _decode_image)
+
+
+def content_hash(data):
+    """ sha256 of the contents of the data, as a hex string
+
+        Files are hashed in chunks, without reading them into memory.
+        Json objects are hashed in their canonical form.
+
+        Args:
+            data (FileStorage or dict): The data
+
+        Returns (str):
+            The hex digest
+    """
+    return cached(data, 'sha256', _hash)
+
+
+def cached(data, name, compute):
+    """ Compute a value from the data, once per data object
+
+        Args:
+            data: The data object, e.g. a FileStorage
+            name (str): Name of the value in the cache
+            compute (function): Computes the value from the data. The
+                stream of the data must be left rewound.
+
+        Returns:
+            The computed value
+    """
+    cache = _cache_of(data)
+    if cache is None:
+        return compute(data)
+    with cache.lock:
+        if name not in cache:
+            cache[name] = compute(data)
+        return cache[name]
+
+
+def peek(data, name):
+    """ A value already computed from the data, None if not computed """
+    cache = _cache_of(data)
+    if cache is None:
+        return None
+    return cache.get(name)
+
+
+def share(src, dst):
+    """ Let dst, e.g. another view of the same file, use src's cache """
+    cache = _cache_of(src)
+    if cache is not None:
+        vars(dst)['_artifacts'] = cache
+
+
+def _cache_of(data):
+    # Only objects with attributes can carry a cache, not e.g. json dicts:
+    if isinstance(data, dict) or not hasattr(data, '__dict__'):
+        return None
+    return vars(data).setdefault('_artifacts', Artifacts())
+
+
+def _hash(data):
+    if isinstance(data, dict):
+        canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+    digest = hashlib.sha256()
+    data.seek(0)
+    try:
+        for chunk in iter(lambda: data.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    finally:
+        data.seek(0)
+    return digest.hexdigest()
+
+
+def _read_image_info(data):
+    from PIL import Image
+    data.seek(0)
+    try:
+        with Image.open(data) as im:
+            return _info(im)
+    finally:
+        data.seek(0)
+
+
+def _decode_image(data):
+    from PIL import Image
+    data.seek(0)
+    try:
+        im = Image.open(data)
+        im.load()
+        return im
+    finally:
+        data.seek(0)
+
+
+def _info(im):
+    return {
+        'format': im.format,
+        'width': im.width,
+        'height': im.height,
+        'mode': im.mode,
+    }
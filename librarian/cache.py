@@ -0,0 +1,56 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class QueryCache:
+    """ Least recently used cache with entries expiring after a while
+
+        clear() is called on writes. A result computed before a clear
+        must not be stored after it, so results are stored with the
+        generation read before computing them, and dropped if a clear
+        happened in between.
+
+        Args:
+            maxsize (int): Maximum number of entries. 0 disables caching.
+            ttl (float): Seconds an entry stays valid
+    """
+    def __init__(self, maxsize=256, ttl=10):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"{self.__class__.__name__}(maxsize={self.maxsize}, ttl={self.ttl})"
+
+    def get(self, key):
+        """ Cached value of the key, None if missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation):
+        """ Store a value computed when the cache was at generation """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
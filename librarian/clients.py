@@ -0,0 +1,99 @@
+import os
+import threading
+
+
+class ClientRegistry:
+    """ Clients of remote services shared by the whole process
+
+        Clients are created on first use and shared by everything using
+        the same connection parameters, e.g. all the actors and indexes
+        of one mongo cluster. After a fork the clients of the parent are
+        forgotten and new ones created on use, as e.g. MongoClient must
+        not be used across a fork. Creating actors before gunicorn forks
+        (--preload) is thus safe.
+
+        Args:
+            factories (dict): kind: function creating a client from the
+                connection parameters as keyword arguments
+    """
+    def __init__(self, factories):
+        self.factories = dict(factories)
+        self._clients = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, kind, **params):
+        """ The client of a kind for the parameters, created if needed """
+        key = (kind, tuple(sorted(params.items())))
+        if self._pid == os.getpid():
+            client = self._clients.get(key)
+            if client is not None:
+                return client
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self.factories[kind](**params)
+        return client
+
+    def __len__(self):
+        return len(self._clients) if self._pid == os.getpid() else 0
+
+
+def _create_mongo(usr, pwd, url, db, pool_size):
+    from pymongo import MongoClient
+    # Create mLab string:
+    mongo_str =  f'mongodb://{usr}:{pwd}@{url}/{db}'
+    mongo_str += '?retrywrites=false'
+    return MongoClient(mongo_str, maxPoolSize=pool_size, connect=False)
+
+
+def _create_s3(access_key, secret_key, endpoint_url, pool_size):
+    import boto3
+    from botocore.config import Config
+    return boto3.client(
+        's3', aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+        endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=pool_size)
+    )
+
+
+clients = ClientRegistry({
+    'mongo': _create_mongo,
+    's3': _create_s3,
+})
+
+
+def mongo_client(usr, pwd, url, db, pool_size=100):
+    """ Shared client for a mongoDB, e.g. on mLab
+
+        Args:
+            usr (str): Username for the mongoDB connection
+            pwd (str): Password for the mongoDB connection
+            url (str): mongoDB connection url
+            db (str): mongoDB database to authenticate to
+            pool_size (int): Maximum connections of the process to it
+
+        Returns (MongoClient):
+            The client
+    """
+    return clients.get('mongo', usr=usr, pwd=pwd, url=url, db=db,
+                       pool_size=int(pool_size))
+
+
+def s3_client(access_key, secret_key, endpoint_url=None, pool_size=10):
+    """ Shared low level boto3 client for S3
+
+        Args:
+            access_key (str): AWS access key id
+            secret_key (str): AWS secret access key
+            endpoint_url (str): Another S3 compatible service, if any
+            pool_size (int): Maximum connections of the process to it
+
+        Returns (botocore.client.S3):
+            The client, which unlike boto3 resources is thread safe
+    """
+    return clients.get('s3', access_key=access_key, secret_key=secret_key,
+                       endpoint_url=endpoint_url, pool_size=int(pool_size))
@@ -0,0 +1,130 @@
+from librarian.clients import mongo_client
+import os
+import sqlite3
+import threading
+import time
+
+
+class LocalHashIndex:
+    """ Index of stored content hashes in a local SQLite file
+
+        Can be shared by the processes of one host.
+
+        Args:
+            path (str): SQLite file of the index. The directory should
+                already exist!
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    hash TEXT PRIMARY KEY,
+                    uid TEXT NOT NULL,
+                    created REAL NOT NULL
+                )""")
+
+    def __str__(self):
+        return f"{self.__class__.__name__}: {self.path}"
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def find(self, digest):
+        """ uid of the upload that stored the content, None if not stored
+
+            Args:
+                digest (str): Hash of the content
+
+            Returns (str):
+                The uid, None if the content is not stored yet
+        """
+        row = self._connect().execute(
+            "SELECT uid FROM hashes WHERE hash = ?", (digest,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, digest, uid):
+        """ Register the content as stored by uid
+
+            Call only once the data is stored, as later uploads of the
+            same content skip storing it. The first upload to register
+            the content keeps it.
+        """
+        self._connect().execute(
+            "INSERT OR IGNORE INTO hashes (hash, uid, created) VALUES (?, ?, ?)",
+            (digest, uid, time.time())
+        )
+
+
+class MongoHashIndex:
+    """ Index of stored content hashes in a mongoDB collection
+
+        A unique index on the hash keeps the first upload registering
+        the content, across any number of hosts.
+
+        Args:
+            usr (str): Username for the mongoDB connection
+            pwd (str): Password for the mongoDB connection
+            url (str): mongoDB connection url
+            db (str): mongoDB database name
+            col (str): mongoDB collection name for the hashes
+            pool_size (int): Maximum connections of the process to the
+                database, shared with the actors using the same arguments
+    """
+    def __init__(self, usr, pwd, url, db, col, pool_size=100):
+        self.url = url
+        self._connection = (usr, pwd, url, db, pool_size)
+        self.db_name = db
+        self.col_name = col
+        self.col.create_index('hash', unique=True)
+
+    @property
+    def col(self):
+        # The shared client is replaced after a fork:
+        return mongo_client(*self._connection)[self.db_name][self.col_name]
+
+    def __str__(self):
+        return f"{self.__class__.__name__}: {self.url}/{self.col.name}"
+
+    def find(self, digest):
+        found = self.col.find_one({'hash': digest}, {'uid': 1})
+        return found['uid'] if found is not None else None
+
+    def add(self, digest, uid):
+        from pymongo.errors import DuplicateKeyError
+        try:
+            self.col.insert_one({'hash': digest, 'uid': uid})
+        except DuplicateKeyError:
+            # Stored by another upload at the same time
+            pass
+
+
+def configure_dedup(config):
+    """ Create the hash index for deduplication from DEDUP_CONFIG
+
+        Args:
+            config (dict): {"index": "local", "path": <file>} or
+                {"index": "mongo", "args": [usr, pwd, url, db, col]}
+
+        Returns:
+            The hash index, None if config is empty
+
+        Raises:
+            KeyError if configuration key is not found in options.
+    """
+    if not config:
+        return None
+    indexes = {
+        'local': lambda c: LocalHashIndex(c['path']),
+        'mongo': lambda c: MongoHashIndex(*c.get('args', []),
+                                          **c.get('kwargs', {})),
+    }
+    return indexes[config['index']](config)
@@ -5,10 +5,9 @@ from librarian.validators import validators, xvalidators
 def describe_crossvalidator_options():
     """ Print options for cross validators and their arguments
     """
-    print("* Currently supported options for",
-          "LABEL_ACTOR_CONFIG and DATA_ACTOR_CONFIG:*", )
-    for tag, validator in validators.items():
-        print("'"+tag+"':", validator.describe())
+    print("* Currently supported options for CROSS_VALID_CONFIG: *")
+    for tag in xvalidators:
+        print("'"+tag+"':", xvalidators.describe(tag))
 
 
 def describe_validator_options():
@@ -16,16 +15,17 @@ def describe_validator_options():
     """
     print("* Currently supported options for",
           "LABEL_VALID_CONFIG and DATA_VALID_CONFIG:*", )
-    for tag, validator in validators.items():
-        print("'"+tag+"'", validator.describe())
+    for tag in validators:
+        print("'"+tag+"'", validators.describe(tag))
 
 
 def describe_actor_options():
     """ Print options for actors and their arguments
     """
-    print("* Currently supported options for CROSS_ACTOR_CONFIG: *")
-    for tag, actor in actors.items():
-        print("'"+tag+"'", actor.describe())
+    print("* Currently supported options for",
+          "LABEL_ACTOR_CONFIG and DATA_ACTOR_CONFIG:*", )
+    for tag in actors:
+        print("'"+tag+"'", actors.describe(tag))
 
 
 def describe_input_options():
@@ -36,7 +36,13 @@ def describe_input_options():
     DATA_TYPE:
         'file': Expects a file. Reads the request.files field
         'json': Expects json dict. Reads the request.json field
-        'base64': Expects base64 encoded string. Reads the request.form field
+        'base64': Expects base64 encoded string. Reads the request.form field,
+            or the request.files field to stream large payloads
+        'stream': Expects a multipart body, with the labels in the form
+            fields before the file. The file is streamed to the data actors
+            as it arrives. Data validators only see its first chunk, so
+            the ones needing the whole file (img, dhash) are refused, as
+            are the image actor without a spool and deduplication.
 
     DATA_TAG:
         This value can be anything. It is used to extract the data from
@@ -5,4 +5,14 @@ class EnvironmentVariableLoadException(Exception):
 
 class InitialisationError(Exception):
     def __init__(self,*args,**kwargs):
-        super().__init__(*args, **kwargs)
\ No newline at end of file
+        super().__init__(*args, **kwargs)
+
+class UploadOffsetError(Exception):
+    """ Raised when a chunk is not sent at the offset of an upload
+
+        Args:
+            offset (int): Bytes of the upload received so far
+    """
+    def __init__(self, offset, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.offset = offset
@@ -0,0 +1,81 @@
+import json
+
+
+def ndjson_chunks(docs, chunk_size=64*1024):
+    """ Encode documents as newline delimited json, in chunks
+
+        Lines are joined into chunks of about chunk_size bytes, which is
+        much cheaper to write or send than a line at a time.
+
+        Args:
+            docs (iterator): dicts to encode
+            chunk_size (int): Approximate size of the chunks in bytes
+
+        Returns (iterator):
+            Chunks of encoded lines as bytes
+    """
+    lines = []
+    size = 0
+    for doc in docs:
+        line = json.dumps(doc, default=str).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def export_ndjson(actor, out, filters=None, fields=None, batch_size=1000):
+    """ Write everything an actor has stored to a file as ndjson
+
+        Args:
+            actor (Actor): Actor supporting export()
+            out (file): Binary file to write to
+            filters (dict): Values the fields must equal
+            fields (list): Fields to export. Defaults to all.
+            batch_size (int): Objects to fetch from storage at once
+
+        Returns (int):
+            Number of bytes written
+    """
+    written = 0
+    docs = actor.export(filters=filters, fields=fields, batch_size=batch_size)
+    for chunk in ndjson_chunks(docs):
+        out.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def revalidate(actor, validator, filters=None, batch_size=1000):
+    """ Validate everything an actor has stored, a batch at a time
+
+        The fields added by Librarian, uid and data_uid, are left out, so
+        the labels are validated as they were uploaded.
+
+        Args:
+            actor (Actor): Actor supporting export()
+            validator (Validator): Validator for the labels
+            filters (dict): Values the fields must equal
+            batch_size (int): Labels to validate at once
+
+        Returns (iterator):
+            (labels, passed) of every stored label
+    """
+    docs = actor.export(filters=filters, batch_size=batch_size)
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield from _validate_batch(validator, batch)
+            batch = []
+    if batch:
+        yield from _validate_batch(validator, batch)
+
+
+def _validate_batch(validator, docs):
+    added = ('uid', 'data_uid')
+    labels = [{k: v for k, v in d.items() if k not in added} for d in docs]
+    return zip(docs, validator.validate_many(labels))
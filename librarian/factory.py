@@ -1,23 +1,76 @@
 from flask import Flask, jsonify, request, render_template
 from flask import abort, redirect, send_from_directory, make_response
+from flask import Response, g, url_for
 # from flask_cors import CORS, cross_origin
 from werkzeug.datastructures import FileStorage
 from librarian.validators.exceptions import ValidationError
+from librarian.actors.exceptions import ActorBusyError
+from librarian.exceptions import UploadOffsetError, InitialisationError
+from librarian.actors.actor import run_actors
+from librarian.export import ndjson_chunks
+from librarian.artifacts import content_hash, cached
+from librarian.metrics import Metrics
+from librarian.streaming import MultipartStream, Pipe
+from io import BytesIO
 import json
 import sys
 import os
-from io import BytesIO
-import base64
+import tempfile
+import sqlite3
+import binascii
+import time
 from bson.objectid import ObjectId
 
 
 def create_librarian(datatype, datatag,
                      label_validator, label_actor,
                      data_validator, data_actor,
-                     cross_validator):
+                     cross_validator, spool=None, spool_workers=None,
+                     dedup=None, metrics=None, profiler=None, uploads=None):
+    """ Create the Librarian flask app
+
+        Args:
+            datatype (str): Type of data expected to be received
+            datatag (str): Tag under which the data is found in request
+            label_validator (Validator): Validator for the labels
+            label_actor (Actor): Actor for the labels
+            data_validator (Validator): Validator for the data
+            data_actor (Actor): Actor for the data
+            cross_validator (Validator): Validator for labels and data
+            spool (Spool): If given, uploads are validated and stored to
+                the spool, and answered with 202 before the actors run.
+            spool_workers (SpoolWorkers): Workers draining the spool in
+                this process. None if drained by separate processes.
+            dedup (HashIndex): If given, data already stored is not
+                stored again. The labels link to the stored data with
+                the "data_uid" field instead.
+            metrics (Metrics): Metrics served at /metrics. Defaults to
+                metrics of this process only.
+            profiler (Profiler): If given, uploads can be profiled, and
+                the stats read from /admin/profile.
+            uploads (UploadSessions): If given, large data can be sent in
+                chunks as resumable uploads under /uploads.
+
+        Returns (flask.app):
+            An app ready to run.
+
+        Raises:
+            InitialisationError: if the validators, actors or dedup cannot
+                work with the datatype
+    """
+    if datatype == 'stream':
+        _check_streamable(data_validator, cross_validator, data_actor,
+                          spool, dedup)
+
     app = Flask(__name__)
     # CORS(app)
     app.config['CORS_HEADERS'] = 'Content-Type'
+    if metrics is None:
+        metrics = Metrics()
+    # Labels in the url are parsed to the types the validators expect:
+    parse_labels = label_parser(
+        getattr(label_validator, 'schema', dict)()
+    )
 
     def _build_cors_prelight_response():
         response = make_response()
@@ -30,13 +83,97 @@ def create_librarian(datatype, datatag,
         response.headers.add("Access-Control-Allow-Origin", "*")
         return response
 
-    def _abort(code, msg):
+    def _abort(code, msg, reason=None, **details):
+        g.reason = reason
         abort(
             _corsify_actual_response(
-                make_response(jsonify(message=msg), code)
+                make_response(jsonify(message=msg, **details), code)
             )
         )
 
+    def _validate(labels, data, labels_valid=False):
+        """ Run the validator chain. Raises ValidationError on failure """
+        # 1. Run label validator on label(s), unless done for a batch
+        if not labels_valid:
+            with metrics.timer('label_validation'):
+                label_validator(labels)
+        # 2. Run data validator for data
+        with metrics.timer('data_validation'):
+            data_validator(data)
+        # 3. Run cross validator for label(s) and data
+        with metrics.timer('cross_validation'):
+            cross_validator(labels, data)
+
+    def _commit(labels, data):
+        """ Let the validators remember an upload, once it is stored """
+        try:
+            label_validator.commit(labels)
+            data_validator.commit(data)
+            cross_validator.commit(labels, data)
+        except Exception as e:
+            # The upload is stored, only later duplicates may get through:
+            print("[VALIDATOR ERROR]:", str(e), file=sys.stderr)
+
+    def _reject(error):
+        """ Abort with the reason a ValidationError was raised """
+        print("[VALIDATION ERROR]:", str(error), file=sys.stderr)
+        _abort(415, str(error), error.validator or 'validation',
+               **_error_details(error))
+
+    def _record_actors(stage, results):
+        """ Observe the time and errors of the actors of a stage """
+        if results:
+            metrics.observe('librarian_stage_seconds',
+                            max(r.seconds for r in results),
+                            stage=stage.lower()+'_actor')
+        for result in results:
+            if result.error is not None:
+                metrics.inc('librarian_actor_errors_total', stage=stage.lower(),
+                            actor=result.actor.__class__.__name__)
+
+    @app.after_request
+    def _record_request(response):
+        if request.endpoint in UPLOAD_ENDPOINTS:
+            metrics.inc('librarian_requests_total', endpoint=request.endpoint,
+                        status=response.status_code,
+                        reason=g.get('reason') or '')
+            if request.content_length:
+                metrics.observe('librarian_request_bytes',
+                                request.content_length,
+                                endpoint=request.endpoint)
+        return response
+
+    if profiler is not None:
+        @app.before_request
+        def _start_profile():
+            if request.endpoint in UPLOAD_ENDPOINTS:
+                g.profile = profiler.start(request.headers)
+
+        @app.teardown_request
+        def _stop_profile(error=None):
+            session = g.pop('profile', None)
+            if session is not None:
+                profiler.stop(session)
+
+        @app.route('/admin/profile', methods=['GET'])
+        def profile_getter():
+            """ Profiling stats of this process. Needs the profiling
+                header with the token, disabled if no token is set.
+                reset=true to clear the stats after reading them.
+            """
+            if not profiler.authorized(request.headers):
+                _abort(403, "Not authorized")
+            report = profiler.report()
+            if request.args.get('reset') == 'true':
+                profiler.reset()
+            return Response(report, mimetype='text/plain')
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_getter():
+        """ Metrics of all the processes in the Prometheus text format """
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     @app.route('/')
     def index():
         return redirect('http://github.com/oikone', code=302)
@@ -48,80 +185,608 @@ def create_librarian(datatype, datatag,
         if request.method == "OPTIONS": # CORS preflight
             return _build_cors_prelight_response()
 
-        labels = parse_url_args(request.args)
+        parse_start = time.perf_counter()
+        labels = parse_labels(request.args)
+        if datatype=="stream":
+            return _put_stream(labels, parse_start)
         if datatype=="file":
             if request.files is None:
                 print("[INPUT ERROR]: No files in request", file=sys.stderr)
-                _abort(406, "Invalid input data") 
+                _abort(406, "Invalid input data", 'invalid_input') 
             data = request.files.get(datatag, 0)
         elif datatype=='base64':
-            if not request.form:
+            # Large payloads can be sent as a file part to stream them:
+            raw64 = request.files.get(datatag) or request.form.get(datatag)
+            if not raw64:
                 print("[INPUT ERROR]: No form in request", file=sys.stderr)
-                _abort(406, "Invalid input data") 
-            raw64 = request.form[datatag]
-            # Make sure we don't have any nasty tags:
-            raw64 = raw64.split(',')[-1]
-            data = FileStorage(
-                stream=BytesIO(base64.b64decode(raw64)),
-                filename=labels.get('filename', 'input')
-            )
+                _abort(406, "Invalid input data", 'invalid_input') 
+            try:
+                data = _decode_base64(raw64, labels.get('filename', 'input'))
+            except binascii.Error as e:
+                print("[INPUT ERROR]: Invalid base64:", str(e), file=sys.stderr)
+                _abort(406, "Invalid input data", 'invalid_input')
         elif datatype=="json":
             if request.json is None:
                 print("[INPUT ERROR]: No json in request", file=sys.stderr)
-                _abort(406, "Invalid input data") 
+                _abort(406, "Invalid input data", 'invalid_input') 
             # default value of no data tag: get full json from request:
             data = request.json.get(datatag, 0) if datatag else request.json
         else:
             print("[INPUT ERROR]: Unexpected datatype: '"+datatype+"'", file=sys.stderr)
-            _abort(406, "Invalid data type")
+            _abort(406, "Invalid data type", 'invalid_input')
 
 
         if not data:
             print("[INPUT ERROR]: No data", file=sys.stderr)
-            _abort(406, "Data tag not found")
+            _abort(406, "Data tag not found", 'invalid_input')
+        metrics.observe('librarian_stage_seconds',
+                        time.perf_counter() - parse_start, stage='parse')
+        return _store(labels, data)
 
-        try:
-            # 1. Run label validator on label(s)
-            label_validator(labels)
-            # 2. Run data validator for data
-            data_validator(data)
-            # 3. Run cross validator for label(s) and data
-            cross_validator(labels, data)
-        except ValidationError as e:
-            print("[VALIDATION ERROR]:", str(e), file=sys.stderr)
-            _abort(415, str(e))
+    def _store(labels, data, uid=None, validated=False):
+        """ Validate an upload, then spool it or run the actors on it
+
+            Args:
+                labels (dict): Labels of the upload
+                data: Data of the upload
+                uid (str): uid for the upload, a new one if None
+                validated (bool): Whether already validated
+
+            Returns (flask.Response):
+                The response to the upload
+        """
+        if not validated:
+            try:
+                _validate(labels, data)
+            except ValidationError as e:
+                _reject(e)
 
         # if everything is ok, create a unique ID:
-        uid = str(ObjectId())
+        uid = uid or str(ObjectId())
+        digest, duplicate = _dedup(labels, data)
+
+        if spool is not None:
+            try:
+                _spool_put(uid, labels, data, skip_data=duplicate,
+                           digest=digest)
+            except (OSError, sqlite3.Error) as e:
+                print("[SPOOL ERROR]:", str(e), file=sys.stderr)
+                _abort(503, "Could not store the upload, try again later",
+                       'spool_error')
+            _commit(labels, data)
+            return _corsify_actual_response(make_response(
+                jsonify(uid=uid, status='queued'), 202
+            ))
 
-        # 5. Run label action
+        # 5. & 6. Run label and data actions concurrently
+        jobs = [(label_actor, labels, uid)]
+        if not duplicate:
+            jobs.append((data_actor, data, uid))
+        label_results, *data_results = run_actors(jobs)
+        data_results = data_results[0] if data_results else []
+        if digest and all(r.error is None for r in data_results):
+            _register(digest, uid)
+        _check_actors(label_results, data_results)
+        _commit(labels, data)
+        label_actor_response = _responses(label_results)
+        data_actor_response = _responses(data_results)
+        if duplicate:
+            data_actor_response = f"Duplicate of {labels['data_uid']}"
+
+        # 7. Return success
+        return _processed(label_actor_response, data_actor_response)
+
+    def _put_stream(labels, parse_start):
+        """ /put for the 'stream' datatype
+
+            The multipart body is read as it arrives. The form fields
+            before the file part under the data tag are labels: a field
+            "labels" holding a json dict, the others parsed like the url
+            labels. The labels are validated before the file is read.
+            The data and cross validators get the file with only its
+            first chunk, e.g. to check the filename or the file type.
+            The file is then passed on to the data actors, or the spool,
+            chunk by chunk without holding it in memory. The label actors
+            run only once the data is stored, as the body may still fail
+            to arrive, e.g. when the client goes away.
+        """
+        fields, json_labels, part = {}, {}, None
         try:
-            label_actor_response = label_actor.act(labels, uid)
-        except Exception as e:
-            print("[LABEL ACTOR ERROR]:", str(e), file=sys.stderr)
-            _abort(415, "Error occurred during LABEL actor: "+str(e))
+            body = MultipartStream(request.stream,
+                                   request.mimetype_params.get('boundary'))
+            part = body.next_part()
+            while part is not None and part[0] != datatag:
+                if part[0] == 'labels':
+                    json_labels = json.loads(body.read_field())
+                    if not isinstance(json_labels, dict):
+                        raise ValueError("Labels must be a json dict")
+                elif part[0]:
+                    fields[part[0]] = body.read_field()
+                part = body.next_part()
+            head = body.read(body.chunk_size) if part is not None else b''
+        except ValueError as e:
+            print("[INPUT ERROR]:", str(e), file=sys.stderr)
+            _abort(406, "Invalid input data: "+str(e), 'invalid_input')
+        if not head:
+            print("[INPUT ERROR]: No data", file=sys.stderr)
+            _abort(406, "Data tag not found", 'invalid_input')
+        labels = {**labels, **parse_labels(fields), **json_labels}
+        name, filename, headers = part
+        metrics.observe('librarian_stage_seconds',
+                        time.perf_counter() - parse_start, stage='parse')
 
-        # 6. Run data action
         try:
-            data_actor_response = data_actor.act(data, uid)
-        except Exception as e:
-            print("[DATA ACTOR ERROR]:", str(e), file=sys.stderr)
-            _abort(416, "Error occurred during DATA actor: "+str(e))
+            with metrics.timer('label_validation'):
+                label_validator(labels)
+            # Validators only see the head, the rest is yet to arrive:
+            validated = FileStorage(stream=BytesIO(head), filename=filename,
+                                    name=name, headers=headers)
+            _validate(labels, validated, labels_valid=True)
+        except ValidationError as e:
+            _reject(e)
 
-        # 7. Return success
-        resp = _corsify_actual_response(make_response(
+        uid = str(ObjectId())
+        body.unread(head)
+        if spool is not None:
+            try:
+                _spool_put(uid, labels, FileStorage(
+                    stream=body, filename=filename, name=name,
+                    headers=headers
+                ))
+            except ValueError as e:
+                print("[INPUT ERROR]:", str(e), file=sys.stderr)
+                _abort(406, "Invalid input data: "+str(e), 'invalid_input')
+            except (OSError, sqlite3.Error) as e:
+                print("[SPOOL ERROR]:", str(e), file=sys.stderr)
+                _abort(503, "Could not store the upload, try again later",
+                       'spool_error')
+            _commit(labels, validated)
+            return _corsify_actual_response(make_response(
+                jsonify(uid=uid, status='queued'), 202
+            ))
+
+        pipe = Pipe()
+        data = FileStorage(stream=pipe.reader(), filename=filename,
+                           name=name, headers=headers)
+
+        def feed():
+            try:
+                for chunk in iter(lambda: body.read(body.chunk_size), b''):
+                    if pipe.closed: # Every data actor has failed
+                        break
+                    pipe.write(chunk)
+            except Exception as e:
+                # E.g. the client went away. The actors raise it:
+                pipe.close(e)
+            else:
+                pipe.close()
+
+        data_results, = run_actors([(data_actor, data, uid)], feed=feed)
+        _check_actors([], data_results)
+        label_results, = run_actors([(label_actor, labels, uid)])
+        _check_actors(label_results, [])
+        _commit(labels, validated)
+        return _processed(_responses(label_results), _responses(data_results))
+
+    def _check_actors(label_results, data_results):
+        """ Record the actors of a request, abort on the first error """
+        _record_actors('LABEL', label_results)
+        _record_actors('DATA', data_results)
+        for stage, results, code in [('LABEL', label_results, 415),
+                                     ('DATA', data_results, 416)]:
+            for result in results:
+                if isinstance(result.error, ActorBusyError):
+                    print(f"[{stage} ACTOR BUSY]:", str(result.error),
+                          file=sys.stderr)
+                    _abort(503, "Service busy, try again later", 'busy')
+            for result in results:
+                if result.error is not None:
+                    print(f"[{stage} ACTOR ERROR]:", str(result.error),
+                          file=sys.stderr)
+                    _abort(code, f"Error occurred during {stage} actor: " +
+                           str(result.error), stage.lower()+'_actor_error')
+
+    def _processed(label_actor_response, data_actor_response):
+        return _corsify_actual_response(make_response(
             jsonify(
                 'Lables and data processed successfully:\n' +
                 f'\tLabel response: {label_actor_response}\n' +
                 f'\tData response: {data_actor_response}'
         ), 200))
-        return resp
 
 
-    @app.route('/get', methods=['GET'])
+    @app.route('/put/batch', methods=['POST', 'OPTIONS'])
+    def batch_putter():
+        """ Validate and act on several label-data pairs in one request
+
+            Labels in the url are shared by every item. Items are read
+            according to the datatype:
+                'file': files under the data tag, with an optional form
+                    field "labels" holding a json list of label dicts
+                    matching the files by index.
+                'json' and 'base64': json body {"items": [{"labels": {},
+                    "data": ...}]}, data being a dict or a base64 string.
+
+            The labels of all the items are validated together, the data
+            of every item on its own. The accepted ones are then
+            passed to the actors in one batch, or stored to the spool if
+            one is used. The response reports the result of each item by
+            its index.
+        """
+        if request.method == "OPTIONS": # CORS preflight
+            return _build_cors_prelight_response()
+
+        shared_labels = parse_labels(request.args)
+        try:
+            items = _read_batch_items(request, datatype, datatag)
+        except ValueError as e:
+            print("[INPUT ERROR]:", str(e), file=sys.stderr)
+            _abort(406, "Invalid input data: "+str(e), 'invalid_input')
+
+        results = []
+        accepted = []
+        digests = {}
+        items = [({**shared_labels, **labels}, data) for labels, data in items]
+        # The labels of the whole batch are validated at once:
+        with metrics.timer('batch_label_validation'):
+            labels_ok = label_validator.validate_many([l for l, _ in items])
+        for i, (labels, data) in enumerate(items):
+            if not data:
+                results.append({'index': i, 'status': 'rejected',
+                                'message': 'Data tag not found'})
+                continue
+            try:
+                if not labels_ok[i]:
+                    # Once more on its own for the reason:
+                    label_validator(labels)
+                    raise ValidationError("Labels rejected")
+                _validate(labels, data, labels_valid=True)
+            except ValidationError as e:
+                print(f"[VALIDATION ERROR]: item {i}:", str(e), file=sys.stderr)
+                results.append({'index': i, 'status': 'rejected',
+                                'message': str(e), **_error_details(e)})
+                continue
+            uid = str(ObjectId())
+            results.append({'index': i, 'status': 'accepted', 'uid': uid})
+            digests[i], duplicate = _dedup(labels, data)
+            accepted.append((i, labels, data, uid, duplicate))
+            if duplicate:
+                results[i]['duplicate_of'] = labels['data_uid']
+
+        if spool is not None:
+            for i, labels, data, uid, duplicate in accepted:
+                try:
+                    _spool_put(uid, labels, data, skip_data=duplicate,
+                               digest=digests[i])
+                    results[i]['status'] = 'queued'
+                    _commit(labels, data)
+                except (OSError, sqlite3.Error) as e:
+                    print("[SPOOL ERROR]:", str(e), file=sys.stderr)
+                    _fail_batch(results, [(i, labels, data, uid, duplicate)],
+                                "Could not store the upload")
+            accepted = []
+
+        if accepted:
+            # 5. & 6. Run label and data actions for the whole batch
+            new = [item for item in accepted if not item[4]]
+            for stage, items, actor_results in zip(
+                    ['LABEL', 'DATA'], [accepted, new], run_actors([
+                        (label_actor, [(l, u) for _, l, _, u, _ in accepted],
+                         None),
+                        (data_actor, [(d, u) for _, _, d, u, _ in new], None),
+                    ], many=True)):
+                _record_actors(stage, actor_results)
+                failed = {}
+                for result in actor_results:
+                    if result.error is not None:
+                        print(f"[{stage} ACTOR ERROR]:", str(result.error),
+                              file=sys.stderr)
+                        failed.update(_failed_items(result.error, len(items)))
+                for n, msg in failed.items():
+                    _fail_batch(results, [items[n]],
+                                f"Error occurred during {stage} actor: " + msg)
+                if stage == 'DATA':
+                    for n, (i, _, _, uid, _) in enumerate(items):
+                        if digests[i] and n not in failed:
+                            _register(digests[i], uid)
+            for i, labels, data, _, _ in accepted:
+                if results[i]['status'] == 'accepted':
+                    _commit(labels, data)
+
+        # 7. Return the results per item
+        for r in results:
+            metrics.inc('librarian_items_total', status=r['status'])
+        n_ok = sum(r['status'] in ('accepted', 'queued') for r in results)
+        return _corsify_actual_response(make_response(
+            jsonify(accepted=n_ok, rejected=len(results)-n_ok,
+                    results=results),
+            200
+        ))
+
+    def _spool_put(uid, labels, data, skip_data=False, digest=None):
+        """ Store a validated item to the spool for the workers """
+        if spool_workers is not None:
+            spool_workers.start()
+        with metrics.timer('spool'):
+            spool.put(uid, labels, data, skip_data=skip_data, digest=digest)
+
+    def _dedup(labels, data):
+        """ Link the labels to the same data stored earlier, if any
+
+            Only data already stored is linked to. Uploads of the same
+            data at the same time both store it.
+
+            Returns (tuple):
+                Hash of the data to register once it is stored, None for
+                a duplicate, and whether the data is a duplicate
+        """
+        if dedup is None:
+            return None, False
+        try:
+            with metrics.timer('dedup'):
+                digest = content_hash(data)
+                owner = dedup.find(digest)
+        except Exception as e:
+            # Storing the data again is better than failing the upload:
+            print("[DEDUP ERROR]:", str(e), file=sys.stderr)
+            return None, False
+        if owner is not None:
+            labels['data_uid'] = owner
+            return None, True
+        return digest, False
+
+    def _register(digest, uid):
+        """ Let later uploads link to the data uid has stored """
+        try:
+            dedup.add(digest, uid)
+        except Exception as e:
+            # Only costs storing the data again later:
+            print("[DEDUP ERROR]:", str(e), file=sys.stderr)
+
+    if uploads is not None:
+        @app.before_request
+        def _expire_uploads():
+            # Every few minutes, before the lock of any upload is taken:
+            if request.endpoint in ('upload_creator', 'upload_patcher',
+                                    'upload_finalizer'):
+                uploads.expire()
+
+        @app.route('/uploads', methods=['POST', 'OPTIONS'])
+        def upload_creator():
+            """ Start a resumable upload
+
+                The labels are given in the url as for /put, and are
+                validated right away. The size of the data can be given
+                in the Upload-Length header. Answers with the uid of the
+                upload, to send the data to in chunks.
+            """
+            if request.method == "OPTIONS": # CORS preflight
+                return _build_cors_prelight_response()
+            if datatype == 'json':
+                _abort(501, "Resumable uploads are not supported for json")
+
+            labels = parse_labels(request.args)
+            size = _header_int('Upload-Length')
+            if None not in (size, uploads.max_size) and size > uploads.max_size:
+                _abort(413, f"Upload larger than {uploads.max_size} bytes")
+            try:
+                with metrics.timer('label_validation'):
+                    label_validator(labels)
+            except ValidationError as e:
+                _reject(e)
+
+            uid = str(ObjectId())
+            uploads.create(uid, labels, labels.get('filename', 'input'), size)
+            response = _upload_response(uid, 0, 201)
+            response.headers['Location'] = url_for('upload_getter', uid=uid)
+            return response
+
+        @app.route('/uploads/<uid>', methods=['GET'])
+        def upload_getter(uid):
+            """ Offset a resumable upload has reached, to resume from """
+            session = uploads.get(uid)
+            if session is None:
+                _abort(404, "No such upload")
+            return _upload_response(uid, session['offset'],
+                                    size=session['size'])
+
+        @app.route('/uploads/<uid>', methods=['PATCH'])
+        def upload_patcher(uid):
+            """ Write a chunk of a resumable upload
+
+                The chunk is the body, starting at the offset in the
+                Upload-Offset header, which must be the offset the upload
+                has reached. A chunk cut short is kept as far as it got.
+                The data actors may store the complete parts right away.
+            """
+            offset = _header_int('Upload-Offset')
+            if offset is None:
+                _abort(400, "No Upload-Offset header")
+            with uploads.lock(uid):
+                try:
+                    offset = uploads.write(uid, offset, request.stream)
+                except KeyError:
+                    _abort(404, "No such upload")
+                except UploadOffsetError as e:
+                    _abort(409, str(e), offset=e.offset)
+                except ValueError as e:
+                    _abort(413, str(e))
+                # Spooled uploads are stored by the workers from scratch:
+                if spool is None:
+                    _stage(uid, offset)
+            return _upload_response(uid, offset)
+
+        @app.route('/uploads/<uid>', methods=['DELETE'])
+        def upload_deleter(uid):
+            """ Abandon a resumable upload """
+            with uploads.lock(uid):
+                session = uploads.get(uid)
+                if session is None:
+                    _abort(404, "No such upload")
+                _discard(session)
+                uploads.remove(uid)
+            return _corsify_actual_response(make_response(
+                jsonify(uid=uid, status='deleted'), 200
+            ))
+
+        @app.route('/uploads/<uid>/finalize', methods=['POST'])
+        def upload_finalizer(uid):
+            """ Validate and store a resumable upload, as /put would
+
+                Uploads rejected by the validators are removed. Others
+                failing, e.g. on an actor error, can be finalized again.
+            """
+            with uploads.lock(uid):
+                session = uploads.get(uid)
+                if session is None:
+                    _abort(404, "No such upload")
+                if not session['offset'] or \
+                        session['offset'] < (session['size'] or 0):
+                    _abort(409, "Upload is not complete",
+                           offset=session['offset'])
+
+                data = uploads.open(uid, name=datatag)
+                # The data actors continue from what they staged:
+                cached(data, 'staged', lambda _: session['staged'])
+                finished = False
+                try:
+                    try:
+                        _validate(session['labels'], data)
+                    except ValidationError as e:
+                        finished = True
+                        _reject(e)
+                    response = _store(session['labels'], data, uid,
+                                      validated=True)
+                    finished = True
+                finally:
+                    data.close()
+                    _discard(session)
+                    if finished:
+                        uploads.remove(uid)
+                    else:
+                        uploads.update(uid, staged={})
+            return response
+
+        def _stage(uid, size):
+            """ Let the data actors store what they can of an upload """
+            session = uploads.get(uid)
+            data = uploads.open(uid)
+            try:
+                data_actor.stage(uid, session['filename'], data.stream, size,
+                                 session['staged'])
+            except Exception as e:
+                # Nothing is lost, the actors store it all when finalized:
+                print("[STAGE ERROR]:", str(e), file=sys.stderr)
+            finally:
+                data.close()
+                uploads.update(uid, staged=session['staged'])
+
+        def _discard(session):
+            """ Drop what the data actors staged and did not use """
+            try:
+                data_actor.discard(session['uid'], session['filename'],
+                                   session['staged'])
+            except Exception as e:
+                print("[STAGE ERROR]:", str(e), file=sys.stderr)
+
+        def _upload_response(uid, offset, code=200, **details):
+            response = make_response(
+                jsonify(uid=uid, offset=offset, **details), code
+            )
+            response.headers['Upload-Offset'] = str(offset)
+            response.headers['Cache-Control'] = 'no-store'
+            return _corsify_actual_response(response)
+
+        def _header_int(name):
+            """ Non-negative integer from a request header, None if none """
+            value = request.headers.get(name)
+            if value is None:
+                return None
+            try:
+                n = int(value)
+            except ValueError:
+                n = -1
+            if n < 0:
+                _abort(400, f"Invalid {name} header")
+            return n
+
+    @app.route('/status/<uid>', methods=['GET'])
+    def status(uid):
+        if spool is None:
+            abort(501, 'API call not implemented')
+        if spool_workers is not None:
+            spool_workers.start()
+        job = spool.status(uid)
+        if job is None:
+            _abort(404, "No such upload")
+        return _corsify_actual_response(make_response(jsonify(job), 200))
+
+    @app.route('/export', methods=['GET'])
+    def exporter():
+        """ Stream all the stored labels as newline delimited json
+
+            Url parameters are filters on the label fields, except:
+                fields: comma separated fields to export
+                batch_size: labels to fetch from storage at once
+        """
+        filters = parse_labels({
+            k: v for k, v in request.args.items() if k not in EXPORT_PARAMS
+        })
+        if any(k.startswith('$') for k in filters):
+            _abort(400, "Invalid filter")
+        fields = request.args.get('fields')
+        fields = [f for f in fields.split(',') if f] if fields else None
+        try:
+            batch_size = int(request.args.get('batch_size', 1000))
+        except ValueError:
+            _abort(400, "Invalid batch size")
+
+        try:
+            docs = label_actor.export(
+                filters=filters, fields=fields, batch_size=batch_size
+            )
+        except NotImplementedError:
+            _abort(501, 'API call not implemented for the label actor')
+        return _corsify_actual_response(Response(
+            ndjson_chunks(docs), mimetype='application/x-ndjson'
+        ))
+
+    @app.route('/get', methods=['GET', 'OPTIONS'])
     def getter():
+        """ Query the stored labels
+
+            Url parameters are filters on the label fields, except:
+                fields: comma separated fields to return
+                after: cursor of the next page, from the previous response
+                limit: number of labels per page, at most MAX_QUERY_LIMIT
+        """
         # Yo momma such a go-getter that ...
-        abort(501, 'API call not implemented')
+        if request.method == "OPTIONS": # CORS preflight
+            return _build_cors_prelight_response()
+
+        filters = parse_labels({
+            k: v for k, v in request.args.items() if k not in QUERY_PARAMS
+        })
+        if any(k.startswith('$') for k in filters):
+            _abort(400, "Invalid filter")
+        fields = request.args.get('fields')
+        fields = [f for f in fields.split(',') if f] if fields else None
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1),
+                        MAX_QUERY_LIMIT)
+        except ValueError:
+            _abort(400, "Invalid limit")
+
+        try:
+            page = label_actor.query(
+                filters=filters, fields=fields,
+                after=request.args.get('after'), limit=limit
+            )
+        except NotImplementedError:
+            _abort(501, 'API call not implemented for the label actor')
+        except ValueError as e:
+            _abort(400, str(e))
+        return _corsify_actual_response(make_response(jsonify(page), 200))
 
     print("\n\n~ Created a Librarian instance. ~")
 
@@ -133,31 +798,276 @@ def create_librarian(datatype, datatag,
     print("[CROSS VALIDATOR]:", str(cross_validator), '\n')
     print("[LABEL ACTOR]:", str(label_actor), '\n')
     print("[DATA ACTOR]:", str(data_actor), '\n')
+    if uploads is not None:
+        print("[UPLOADS]:", str(uploads), '\n')
+    if spool is not None:
+        print("[SPOOL]:", str(spool), '\n')
+        if spool_workers is not None:
+            spool_workers.start()
 
     return app
 
 
 
+def _error_details(error):
+    """ Failed validator and field of a ValidationError, where known """
+    details = {'validator': error.validator, 'field': error.field}
+    return {k: v for k, v in details.items() if v is not None}
+
+
+def _read_batch_items(req, datatype, datatag):
+    """ Read (labels, data) pairs of a batch request
+
+        Args:
+            req (flask.Request): The incoming batch request
+            datatype (str): Expected type of the data
+            datatag (str): Tag under which the files are found for 'file'
+
+        Returns (list):
+            List of (labels, data) tuples
+
+        Raises:
+            ValueError: if the request body does not match the datatype
+    """
+    if datatype == "file":
+        files = req.files.getlist(datatag)
+        labels = json.loads(req.form.get('labels', '[]'))
+        if not isinstance(labels, list):
+            raise ValueError("Form field 'labels' must be a json list")
+        if not all(isinstance(l, dict) for l in labels):
+            raise ValueError("Item labels must be json dicts")
+        if len(labels) > len(files):
+            raise ValueError("More labels than files given")
+        labels += [{}] * (len(files) - len(labels))
+        return list(zip(labels, files))
+
+    if datatype not in ('json', 'base64'):
+        raise ValueError(f"Unexpected datatype: '{datatype}'")
+
+    body = req.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('items'), list):
+        raise ValueError("Expected json body with an 'items' list")
+
+    items = []
+    for item in body['items']:
+        labels = item.get('labels', {}) if isinstance(item, dict) else None
+        if not isinstance(labels, dict):
+            raise ValueError("Item labels must be json dicts")
+        data = item.get('data', 0)
+        if datatype == 'base64' and data:
+            if not isinstance(data, str):
+                raise ValueError("Item data must be a base64 string")
+            try:
+                data = _decode_base64(data, labels.get('filename', 'input'))
+            except binascii.Error as e:
+                raise ValueError(f"Invalid base64 data: {e}")
+        items.append((labels, data))
+    return items
+
+
+def _decode_base64(raw64, filename):
+    """ Decode base64, possibly a data url, into a FileStorage
+
+        The data is decoded in chunks into a spooled temporary file, which
+        moves to disk once larger than BASE64_SPOOL_SIZE, so the memory
+        used stays bounded.
+
+        Args:
+            raw64 (str or FileStorage): base64 string, or a file holding it
+            filename (str): Filename for the FileStorage
+
+        Returns (FileStorage):
+            The decoded data, rewound
+
+        Raises:
+            binascii.Error: if the data is not valid base64
+    """
+    if isinstance(raw64, str):
+        chunks = (raw64[i:i+BASE64_CHUNK].encode('ascii', 'ignore')
+                  for i in range(0, len(raw64), BASE64_CHUNK))
+    else:
+        chunks = iter(lambda: raw64.stream.read(BASE64_CHUNK), b'')
+
+    out = tempfile.SpooledTemporaryFile(max_size=BASE64_SPOOL_SIZE)
+    carry = b''
+    first = True
+    for chunk in chunks:
+        if first:
+            # Make sure we don't have any nasty tags:
+            chunk = chunk[chunk.rfind(b',')+1:]
+            first = False
+        chunk = carry + chunk.translate(None, _NOT_BASE64)
+        # Decode whole 4 character groups, keep the rest for next chunk:
+        cut = len(chunk) - len(chunk) % 4
+        out.write(binascii.a2b_base64(chunk[:cut]))
+        carry = chunk[cut:]
+    if carry:
+        raise binascii.Error("Incorrect padding")
+    out.seek(0)
+    return FileStorage(stream=out, filename=filename)
+
+
+# Endpoints of uploads, for the metrics and the profiler:
+UPLOAD_ENDPOINTS = ('putter', 'batch_putter', 'upload_patcher',
+                    'upload_finalizer')
+
+# Url parameters of /get that are not filters:
+QUERY_PARAMS = ('fields', 'after', 'limit')
+MAX_QUERY_LIMIT = 1000
+# Url parameters of /export that are not filters:
+EXPORT_PARAMS = ('fields', 'batch_size')
+
+# Characters of base64 encoded data in a chunk:
+BASE64_CHUNK = 64 * 1024
+# Decoded data larger than this is spooled to disk:
+BASE64_SPOOL_SIZE = 1024 * 1024
+# Line breaks and such, ignored like base64.b64decode does:
+_NOT_BASE64 = bytes(
+    set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                          b'abcdefghijklmnopqrstuvwxyz0123456789+/=')
+)
+
+
+def _responses(results):
+    """ Single response for a single actor, a list for composites """
+    if len(results) == 1:
+        return results[0].response
+    return [result.response for result in results]
+
+
+def _check_streamable(data_validator, cross_validator, data_actor, spool,
+                      dedup):
+    """ Refuse a 'stream' setup whose uploads could never be stored
+
+        The validators only get the first chunk of the file. Without a
+        spool, the data actors read the file once, forward, as it arrives.
+
+        Raises:
+            InitialisationError: naming what needs the whole file
+    """
+    unfit = [v for validator in (data_validator, cross_validator)
+             for v in getattr(validator, 'validators', [validator])
+             if not getattr(v, 'streamable', True)]
+    if spool is None:
+        leaves = getattr(data_actor, 'leaves', lambda: [data_actor])()
+        unfit += [a for a in leaves if not getattr(a, 'streamable', True)]
+    if unfit:
+        names = ', '.join(sorted({u.__class__.__name__ for u in unfit}))
+        raise InitialisationError(
+            f"The 'stream' datatype does not give the whole file needed "
+            f"by: {names}"
+        )
+    if dedup is not None:
+        raise InitialisationError(
+            "Deduplication needs the whole file before storing it, which "
+            "the 'stream' datatype does not provide"
+        )
+
+
+def _failed_items(error, n):
+    """ Messages by index for the items of a batch an actor error hits
+
+        Bulk inserts, e.g. of mongo, report the documents that failed,
+        the others were stored. Other errors hit the whole batch.
+
+        Args:
+            error (Exception): Error of the actor
+            n (int): Number of items the actor got
+    """
+    details = getattr(error, 'details', None)
+    write_errors = details.get('writeErrors') \
+        if isinstance(details, dict) else None
+    if not write_errors:
+        return {k: str(error) for k in range(n)}
+    return {e['index']: e.get('errmsg', str(error)) for e in write_errors
+            if 0 <= e.get('index', -1) < n}
+
+
+def _fail_batch(results, accepted, msg):
+    """ Mark the accepted items of a batch as failed """
+    for i, *_ in accepted:
+        results[i] = {'index': i, 'status': 'error', 'message': msg}
+
+
+def label_parser(schema):
+    """ Compile a parser of labels given as strings, e.g. in the url
+
+        The fields with a declared type are converted to it. A value not
+        converting is kept as a string, for the validator to reject with
+        a proper message. The types of the other fields are guessed with
+        parse_url_args.
+
+        Args:
+            schema (dict): field: type (str, int, float or bool), e.g.
+                from TypeValidator.schema()
+
+        Returns (function):
+            Parser of a dict of strings to labels
+    """
+    converters = {
+        field: _CONVERTERS.get(t, _guess) for field, t in schema.items()
+    }
+    if not converters:
+        return parse_url_args
+
+    def parse(args):
+        parsed = {}
+        for k, v in args.items():
+            parsed[k] = converters.get(k, _guess)(v)
+        return parsed
+    return parse
+
+
+def _to_int(v):
+    try:
+        return int(v)
+    except ValueError:
+        return v
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+def _to_bool(v):
+    lower = v.lower()
+    if lower in ('true', 'false'):
+        return lower == 'true'
+    return v
+
+
+_CONVERTERS = {
+    str: str,
+    int: _to_int,
+    float: _to_float,
+    bool: _to_bool,
+}
+
+
 def parse_url_args(args):
     """ All the parameters are passed as strings. try to convert them
         back to their original types """
     parsed = {}
     for k, v in args.items():
-        # First, try converting to float and int:
-        try:
-            parsed[k] = int(v)
-            continue
-        except ValueError:
-            pass
-        try:
-            parsed[k] = float(v)
-            continue
-        except ValueError:
-            pass
-        # Then try explicit bool conversion:
-        if v.lower() in ['true', 'false']:
-            parsed[k] = v.lower() == "true"
-        # Finally, just accept it as a string:
-        else:
-            parsed[k] = v
-    return parsed
\ No newline at end of file
+        parsed[k] = _guess(v)
+    return parsed
+
+
+def _guess(v):
+    # First, try converting to float and int:
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    # Then try explicit bool conversion:
+    if v.lower() in ['true', 'false']:
+        return v.lower() == "true"
+    # Finally, just accept it as a string:
+    return v
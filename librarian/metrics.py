@@ -0,0 +1,240 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import atexit
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+
+# Upper bounds of the histogram buckets:
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (1024, 4*1024, 16*1024, 64*1024, 256*1024, 1024**2,
+                 4*1024**2, 16*1024**2, 64*1024**2, 256*1024**2)
+
+# name: (type, help, buckets)
+METRICS = {
+    'librarian_stage_seconds': (
+        'histogram', "Time spent in each stage of handling an upload",
+        SECONDS_BUCKETS),
+    'librarian_request_bytes': (
+        'histogram', "Size of the request bodies", BYTES_BUCKETS),
+    'librarian_requests_total': (
+        'counter', "Requests handled, by status and reason", None),
+    'librarian_items_total': (
+        'counter', "Items of batch uploads, by status", None),
+    'librarian_actor_errors_total': (
+        'counter', "Errors raised by the actors", None),
+}
+
+
+class Metrics:
+    """ Counters and histograms in the Prometheus text format
+
+        Every process keeps its own values in memory. To aggregate the
+        processes of e.g. gunicorn, give a directory shared by them: each
+        process then writes its values to a file of its own there every
+        flush_interval seconds, and render() sums up all the files. The
+        files are named by the pid and the start time of the process, a
+        reused pid gets a file of its own. A process removes its file on
+        exit and the files of processes no longer running are removed
+        when collecting, so the sums drop by the values of an exited
+        process, which Prometheus takes as a counter reset.
+
+        Args:
+            directory (str): Directory shared by the processes, None for
+                metrics of this process only. Will be created if doesn't
+                exist
+            flush_interval (float): Seconds between writes of the file
+    """
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = float(flush_interval)
+        self._values = {}
+        self._pid = None
+        self._file = None
+        self._lock = threading.Lock()
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            atexit.register(self._remove)
+
+    def __str__(self):
+        return (f"{self.__class__.__name__}:\n\tdirectory: {self.directory}"
+                f"\n\tflush_interval: {self.flush_interval}")
+
+    def _start(self):
+        """ Forget the values of the parent process and start flushing """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._values = {}
+            self._pid = os.getpid()
+            if self.directory is not None:
+                self._file = os.path.join(
+                    self.directory,
+                    f"metrics-{self._pid}-{time.time_ns()}.json")
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def inc(self, name, n=1, **labels):
+        """ Add n to a counter """
+        if self._pid != os.getpid():
+            self._start()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        """ Add a value to a histogram """
+        if self._pid != os.getpid():
+            self._start()
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self._lock:
+            # Counts per bucket, the last for +Inf, then the sum:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, stage):
+        """ Observe the seconds spent in the block as a stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('librarian_stage_seconds',
+                         time.perf_counter() - start, stage=stage)
+
+    def flush(self):
+        """ Write the values of this process to its file """
+        if self.directory is None or self._pid != os.getpid():
+            return
+        with self._lock:
+            values = [[name, labels, value]
+                      for (name, labels), value in self._values.items()]
+        with open(self._file + '.tmp', 'w') as f:
+            json.dump(values, f)
+        os.replace(self._file + '.tmp', self._file)
+
+    def _remove(self):
+        """ Remove the file of this process at exit """
+        if self._pid != os.getpid():
+            return
+        self._pid = None
+        try:
+            os.remove(self._file)
+        except OSError:
+            pass
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print("[METRICS ERROR]:", str(e), file=sys.stderr)
+
+    def collect(self):
+        """ Values of all the processes summed up
+
+            Returns (dict):
+                (name, labels): value, a list of bucket counts and the sum
+                for histograms
+        """
+        with self._lock:
+            total = {k: _copy(v) for k, v in self._values.items()}
+        if self.directory is None:
+            return total
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            if path == self._file and self._pid == os.getpid():
+                continue
+            if not _running(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    values = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in values:
+                if name not in METRICS:
+                    continue
+                key = (name, tuple(tuple(l) for l in labels))
+                _add(total, key, value)
+        return total
+
+    def render(self):
+        """ The values of all the processes in the Prometheus text format """
+        values = self.collect()
+        lines = []
+        for name, (kind, help_, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(values.items()):
+                if n != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    le = labels + (('le', str(bound)),)
+                    lines.append(f"{name}_bucket{_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def configure_metrics(config):
+    """ Create the metrics from METRICS_CONFIG, process local if None """
+    if not config:
+        return Metrics()
+    return Metrics(config.get('directory'),
+                   flush_interval=config.get('flush_interval', 5))
+
+
+def _running(path):
+    """ Whether the process that writes the file is still running """
+    try:
+        pid = int(os.path.basename(path).split('-')[1])
+        os.kill(pid, 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def _add(total, key, value):
+    if key not in total:
+        total[key] = _copy(value)
+    elif isinstance(value, list):
+        total[key] = [a + b for a, b in zip(total[key], value)]
+    else:
+        total[key] += value
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                  .replace('\n', '\\n'))
+        for k, v in labels
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from io import BytesIO
+import json
+import os
+import sys
+import tarfile
+import time
+
+
+class ShardWriter:
+    """ Writes samples into numbered tar shards of a limited size
+
+        Every sample is stored as files sharing its uid as basename, e.g.
+        "<uid>.json" and "<uid>.jpg", as WebDataset expects.
+
+        Args:
+            directory (str): Directory for the shards. Will be created if
+                doesn't exist
+            shard_size (int): Start a new shard after this many bytes
+            shard_count (int): Start a new shard after this many samples,
+                0 for no limit
+    """
+    def __init__(self, directory, shard_size=1024**3, shard_count=0):
+        self.directory = directory
+        self.shard_size = int(shard_size)
+        self.shard_count = int(shard_count)
+        self.shards = []
+        self._tar = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, uid, members):
+        """ Write a sample
+
+            Args:
+                uid (str): uid of the sample
+                members (list): (extension, bytes) of the files of it
+        """
+        shard = self.shards[-1] if self.shards else None
+        if (self._tar is None or shard['bytes'] >= self.shard_size
+                or (self.shard_count and shard['count'] >= self.shard_count)):
+            shard = self._next_shard()
+
+        now = time.time()
+        for ext, content in members:
+            info = tarfile.TarInfo(uid + ext)
+            info.size = len(content)
+            info.mtime = now
+            self._tar.addfile(info, BytesIO(content))
+            shard['bytes'] += len(content)
+        shard['count'] += 1
+        shard['last'] = uid
+        shard['first'] = shard['first'] or uid
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def _next_shard(self):
+        self.close()
+        name = f"shard-{len(self.shards):06d}.tar"
+        self._tar = tarfile.open(os.path.join(self.directory, name), 'w')
+        shard = {'name': name, 'count': 0, 'bytes': 0,
+                 'first': None, 'last': None}
+        self.shards.append(shard)
+        return shard
+
+
+def pack(label_actor, data_actor, directory, shard_size=1024**3,
+         shard_count=0, workers=16, filters=None, skip_missing=True):
+    """ Join the stored labels and data by uid into tar shards
+
+        The labels are streamed from the label actor and the data read
+        from the data actor, e.g. local directories or S3, by several
+        threads at once. A manifest.json describing the shards is written
+        next to them.
+
+        Args:
+            label_actor (Actor): Actor supporting export()
+            data_actor (Actor): Actor supporting fetch()
+            directory (str): Directory for the shards
+            shard_size (int): Start a new shard after this many bytes
+            shard_count (int): Start a new shard after this many samples,
+                0 for no limit
+            workers (int): Number of threads reading the data
+            filters (dict): Values the label fields must equal
+            skip_missing (bool): Leave out labels whose data is not found,
+                instead of packing the labels alone
+
+        Returns (dict):
+            The manifest
+    """
+    writer = ShardWriter(directory, shard_size, shard_count)
+    labels = label_actor.export(filters=filters)
+    samples, missing, failed = 0, [], []
+
+    def fetch(label):
+        # Deduplicated uploads link to the data stored earlier:
+        uid = label.get('data_uid', label['uid'])
+        try:
+            return label, data_actor.fetch(uid, label)
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            # Leave the item out rather than the rest of the shards:
+            print(f"[PACKER ERROR]: Could not fetch {uid}:", repr(e),
+                  file=sys.stderr)
+            return label, e
+
+    # Keep a bounded window of reads in flight, in the order of labels:
+    window = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for label in labels:
+            if 'uid' not in label:
+                continue
+            window.append(pool.submit(fetch, label))
+            if len(window) >= workers * 4:
+                samples += _write(writer, window.popleft(), missing,
+                                  failed, skip_missing)
+        while window:
+            samples += _write(writer, window.popleft(), missing, failed,
+                              skip_missing)
+    writer.close()
+
+    manifest = {
+        'created': time.time(),
+        'samples': samples,
+        'missing': len(missing),
+        'failed': len(failed),
+        'shards': writer.shards,
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    if missing:
+        print(f"[PACKER]: No data found for {len(missing)} labels, e.g.",
+              missing[:5], file=sys.stderr)
+    return manifest
+
+
+def _write(writer, future, missing, failed, skip_missing):
+    label, found = future.result()
+    uid = label['uid']
+    if isinstance(found, Exception):
+        failed.append(uid)
+        return 0
+    members = [('.json', json.dumps(label, default=str).encode())]
+    if found is None:
+        missing.append(uid)
+        if skip_missing:
+            return 0
+    else:
+        members.append(found)
+    writer.write(uid, members)
+    return 1
@@ -0,0 +1,217 @@
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import tracemalloc
+
+
+class Profiler:
+    """ Opt-in profiling of single requests with cProfile and tracemalloc
+
+        A request is profiled if it has the profiling header with the
+        token as its value, or at random with the sampling rate. The
+        stats of all the profiled requests are summed up, and written to
+        the directory after every profiled request.
+        The time of the actors is included, as run_actors profiles them
+        too in their threads.
+
+        Only one request is profiled at a time, others arriving meanwhile
+        run normally. Requests not profiled cost a header lookup and a
+        random number.
+
+        Args:
+            directory (str): Directory for the stats, "profile-<pid>.prof"
+                for pstats and "memory-<pid>.txt". None to only serve
+                them from the admin endpoint. Will be created if doesn't
+                exist
+            rate (float): Fraction of the requests to profile
+            header (str): Request header to profile a request with
+            token (str): Value the header must have. Also needed for the
+                admin endpoint. None to profile only by the sampling rate,
+                with the header and the admin endpoint disabled.
+            memory (bool): Also trace the memory allocations, which slows
+                down the profiled requests several times. NOTE: The
+                allocations of other requests running at the same time
+                are included.
+            top (int): Number of functions and allocations to report
+    """
+    def __init__(self, directory=None, rate=0, header='X-Librarian-Profile',
+                 token=None, memory=False, top=30):
+        self.directory = directory
+        self.rate = float(rate)
+        self.header = header
+        self.token = token
+        self.memory = bool(memory)
+        self.top = int(top)
+        self.requests = 0
+        self._stats = None
+        self._allocations = {}
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __str__(self):
+        return (f"{self.__class__.__name__}:\n\tdirectory: {self.directory}"
+                f"\n\trate: {self.rate}\n\theader: {self.header}"
+                f"\n\tmemory: {self.memory}")
+
+    def authorized(self, headers):
+        """ Whether the headers have the token, never without a token """
+        value = headers.get(self.header)
+        if self.token is None or value is None:
+            return False
+        return hmac.compare_digest(value.encode(), str(self.token).encode())
+
+    def start(self, headers):
+        """ Start profiling the request in this thread, if chosen
+
+            Args:
+                headers (dict): Headers of the request
+
+            Returns (Session):
+                The profiling session, None if the request is not profiled
+        """
+        if not (self.authorized(headers)
+                or (self.rate and random.random() < self.rate)):
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        session = Session(self.memory)
+        try:
+            session.start()
+        except ValueError as e: # Another profiler is running
+            print("[PROFILER ERROR]:", str(e), file=sys.stderr)
+            self._busy.release()
+            return None
+        return session
+
+    def stop(self, session):
+        """ Stop a session and add its stats to the totals """
+        try:
+            stats, allocations = session.stop()
+        finally:
+            self._busy.release()
+        with self._lock:
+            self.requests += 1
+            if self._stats is None:
+                self._stats = stats
+            else:
+                self._stats.add(stats)
+            for where, (size, count) in allocations.items():
+                total = self._allocations.setdefault(where, [0, 0])
+                total[0] += size
+                total[1] += count
+        if self.directory is not None:
+            try:
+                self.dump()
+            except OSError as e:
+                print("[PROFILER ERROR]:", str(e), file=sys.stderr)
+
+    def dump(self):
+        """ Write the stats to the directory """
+        pid = os.getpid()
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(
+                    os.path.join(self.directory, f"profile-{pid}.prof")
+                )
+            memory = self._memory_report()
+        with open(os.path.join(self.directory, f"memory-{pid}.txt"), 'w') as f:
+            f.write(memory)
+
+    def report(self):
+        """ The summed up stats as text
+
+            Returns (str):
+                The functions taking most time, and the lines allocating
+                most memory if traced
+        """
+        with self._lock:
+            out = io.StringIO()
+            out.write(f"Profiled requests: {self.requests}\n\n")
+            if self._stats is not None:
+                self._stats.stream = out
+                self._stats.sort_stats('cumulative').print_stats(self.top)
+            out.write(self._memory_report())
+        return out.getvalue()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self._stats = None
+            self._allocations = {}
+
+    def _memory_report(self):
+        if not self._allocations:
+            return ''
+        lines = ["Allocations still held at the end of the requests:"]
+        largest = sorted(self._allocations.items(), key=lambda i: -i[1][0])
+        for where, (size, count) in largest[:self.top]:
+            lines.append(f"{size / 1024:12.1f} KiB {count:8d} blocks  {where}")
+        return '\n'.join(lines) + '\n'
+
+
+class Session:
+    """ Profiling of one request, in its thread and the actor threads """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._main = self.enable()
+        _local.session = self
+
+    def enable(self):
+        """ Profile the current thread as part of the session """
+        profile = cProfile.Profile()
+        profile.enable()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def stop(self):
+        """ Stop profiling
+
+            Returns (tuple):
+                The pstats.Stats, and a dict of "file:line":
+                [bytes, blocks] of the memory still allocated
+        """
+        self._main.disable()
+        _local.session = None
+        allocations = {}
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ])
+            tracemalloc.stop()
+            for stat in snapshot.statistics('lineno'):
+                frame = stat.traceback[0]
+                allocations[f"{frame.filename}:{frame.lineno}"] = \
+                    [stat.size, stat.count]
+        with self._lock:
+            stats = pstats.Stats(*self._profiles)
+        return stats, allocations
+
+
+_local = threading.local()
+
+
+def current():
+    """ The profiling session of the current thread, None if none """
+    return getattr(_local, 'session', None)
+
+
+def configure_profiler(config):
+    """ Create the profiler from PROFILE_CONFIG, None if not configured """
+    if not config:
+        return None
+    return Profiler(**config)
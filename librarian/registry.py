@@ -0,0 +1,76 @@
+from collections.abc import Mapping
+import ast
+import importlib
+import importlib.util
+import threading
+
+
+class LazyRegistry(Mapping):
+    """ Classes by their configuration tags, imported only when used
+
+        Works like a dict of the classes, but the module of a class is
+        imported the first time its tag is looked up. Services only load
+        the dependencies, e.g. boto3 or pymongo, of what they are
+        configured with. Iterating over the values imports everything,
+        use describe() to read the docstrings without importing.
+
+        Args:
+            entries (dict): tag: "module:ClassName"
+    """
+    def __init__(self, entries):
+        self._paths = dict(entries)
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, tag):
+        cls = self._classes.get(tag)
+        if cls is None:
+            module, name = self._paths[tag].split(':')
+            with self._lock:
+                cls = getattr(importlib.import_module(module), name)
+                self._classes[tag] = cls
+        return cls
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._paths})"
+
+    def describe(self, tag):
+        """ Name and docstring of a class, as its describe() returns
+
+            The docstring is read from the source of the module, which is
+            imported only if the class has no docstring of its own.
+
+            Args:
+                tag (str): Tag of the class
+
+            Returns (str):
+                The description
+
+            Raises:
+                KeyError if the tag is not registered
+        """
+        module, name = self._paths[tag].split(':')
+        if tag not in self._classes:
+            doc = _read_docstring(module, name)
+            if doc is not None:
+                return ''.join([name, '\n', doc.strip('\n')])
+        return self[tag].describe()
+
+
+def _read_docstring(module, name):
+    """ Docstring of a class from the source, None if not found """
+    spec = importlib.util.find_spec(module)
+    if spec is None or not spec.origin or not spec.origin.endswith('.py'):
+        return None
+    with open(spec.origin, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), spec.origin)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == name:
+            return ast.get_docstring(node, clean=False)
+    return None
@@ -0,0 +1,421 @@
+from librarian.actors.actor import run_actors
+from werkzeug.datastructures import FileStorage
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+
+class Spool:
+    """ Durable on-disk queue of validated uploads waiting for the actors
+
+        The jobs are kept in a SQLite database in WAL mode, and the data
+        files next to it, so that nothing is lost if the process dies or
+        the actors are unavailable for a while. Several processes can use
+        the same spool directory.
+
+        A claimed job is leased to the claiming worker, which extends the
+        lease while its actors run. If the lease runs out, e.g. because
+        the worker died, the job is claimed again by another worker. Every
+        claim has a token of its own, and the updates of a worker whose
+        lease was taken over are ignored.
+
+        A failed job is retried after a delay doubling on every attempt,
+        so that e.g. an outage of mongo or S3 does not use up the attempts
+        at once. Jobs failed for good keep their data, and can be put back
+        to the queue with requeue().
+
+        Args:
+            directory (str): Directory for the spool. Will be created if
+                doesn't exist
+            max_attempts (int): Times to try the actors before giving up
+            lease (float): Seconds a worker has to finish a claimed job
+            retry_delay (float): Seconds to wait before the first retry
+            max_retry_delay (float): Longest wait between the retries
+    """
+    def __init__(self, directory, max_attempts=5, lease=300, retry_delay=5,
+                 max_retry_delay=600):
+        self.directory = directory
+        self.max_attempts = int(max_attempts)
+        self.lease = float(lease)
+        self.retry_delay = float(retry_delay)
+        self.max_retry_delay = float(max_retry_delay)
+        self.datadir = os.path.join(directory, 'data')
+        if not os.path.isdir(self.datadir):
+            os.makedirs(self.datadir)
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    uid TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    data TEXT,
+                    filename TEXT,
+                    name TEXT,
+                    label_done INTEGER NOT NULL DEFAULT 0,
+                    data_done INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    lease_until REAL,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    digest TEXT,
+                    token TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            db.execute("""CREATE INDEX IF NOT EXISTS jobs_status
+                          ON jobs (status, created)""")
+            # Spools created before the retry delays, dedup and tokens:
+            columns = [c[1] for c in db.execute("PRAGMA table_info(jobs)")]
+            if 'not_before' not in columns:
+                db.execute("""ALTER TABLE jobs ADD COLUMN
+                              not_before REAL NOT NULL DEFAULT 0""")
+            if 'digest' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN digest TEXT")
+            if 'token' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN token TEXT")
+
+    def __str__(self):
+        return (f"{self.__class__.__name__}:\n\tdirectory: {self.directory}"
+                f"\n\tmax_attempts: {self.max_attempts}"
+                f"\n\tlease: {self.lease}"
+                f"\n\tretry_delay: {self.retry_delay}")
+
+    def _connect(self):
+        """ Connection of the current thread and process """
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(
+                os.path.join(self.directory, 'spool.sqlite3'),
+                timeout=30, isolation_level=None
+            )
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=FULL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def put(self, uid, labels, data, skip_data=False, digest=None):
+        """ Store a validated upload for the workers
+
+            Args:
+                uid (str): Unique id of the upload, used as the job id
+                labels (dict): Validated labels
+                data: Validated data, a FileStorage or a json object
+                skip_data (bool): Run only the label actors, e.g. when
+                    the data is already stored
+                digest (str): Hash of the data, to register in the dedup
+                    index once the data is stored
+        """
+        now = time.time()
+        record, filename, name = None, None, None
+        if skip_data:
+            record = 'null'
+        elif isinstance(data, FileStorage):
+            filename, name = data.filename, data.name
+            path = os.path.join(self.datadir, uid)
+            data.stream.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(data.stream, f)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            record = json.dumps(data)
+
+        with self._connect() as db:
+            db.execute(
+                """INSERT INTO jobs (uid, status, labels, data, filename,
+                                     name, data_done, digest, created,
+                                     updated)
+                   VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (uid, json.dumps(labels), record, filename, name,
+                 bool(skip_data), digest, now, now)
+            )
+
+    def claim(self):
+        """ Lease the oldest waiting job
+
+            Returns (sqlite3.Row):
+                The job, or None if there is nothing to do
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            job = db.execute(
+                """SELECT * FROM jobs
+                   WHERE (status = 'queued' AND not_before <= ?)
+                      OR (status = 'running' AND lease_until < ?)
+                   ORDER BY created LIMIT 1""", (now, now)
+            ).fetchone()
+            if job is not None:
+                db.execute(
+                    """UPDATE jobs SET status = 'running', lease_until = ?,
+                           attempts = attempts + 1, token = ?, updated = ?
+                       WHERE uid = ?""",
+                    (now + self.lease, uuid.uuid4().hex, now, job['uid'])
+                )
+                # With the attempt just started counted:
+                job = db.execute(
+                    "SELECT * FROM jobs WHERE uid = ?", (job['uid'],)
+                ).fetchone()
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return job
+
+    def load(self, job):
+        """ Labels and data of a claimed job, as they were put """
+        labels = json.loads(job['labels'])
+        if job['data'] is not None:
+            return labels, json.loads(job['data'])
+        data = FileStorage(
+            stream=open(os.path.join(self.datadir, job['uid']), 'rb'),
+            filename=job['filename'], name=job['name']
+        )
+        return labels, data
+
+    def extend(self, job):
+        """ Renew the lease of a claimed job
+
+            Returns (bool):
+                Whether the job is still leased to the caller
+        """
+        now = time.time()
+        with self._connect() as db:
+            return db.execute(
+                """UPDATE jobs SET lease_until = ?, updated = ?
+                   WHERE uid = ? AND token = ? AND status = 'running'""",
+                (now + self.lease, now, job['uid'], job['token'])
+            ).rowcount > 0
+
+    def mark(self, job, label_done=False, data_done=False):
+        """ Remember the stages already done, so they are not retried """
+        with self._connect() as db:
+            db.execute(
+                """UPDATE jobs SET label_done = label_done OR ?,
+                       data_done = data_done OR ?, updated = ?
+                   WHERE uid = ? AND token = ? AND status = 'running'""",
+                (label_done, data_done, time.time(), job['uid'], job['token'])
+            )
+
+    def done(self, job):
+        """ Finish a claimed job, unless its lease was taken over """
+        self._finish(job, 'done', None)
+
+    def fail(self, job, error):
+        """ Put a claimed job back in the queue, or fail it for good
+
+            Ignored if the lease of the job was taken over.
+
+            Args:
+                job (sqlite3.Row): The job, as claimed
+                error (str): What went wrong
+
+            Returns (bool):
+                Whether the job failed for good
+        """
+        if job['attempts'] >= self.max_attempts:
+            return self._finish(job, 'failed', error)
+        delay = min(self.retry_delay * 2 ** (job['attempts'] - 1),
+                    self.max_retry_delay)
+        self._finish(job, 'queued', error, not_before=time.time() + delay)
+        return False
+
+    def requeue(self, uid=None):
+        """ Put jobs failed for good back in the queue, with new attempts
+
+            Args:
+                uid (str): Job to requeue, None for all the failed ones
+
+            Returns (int):
+                Number of jobs requeued
+        """
+        query = """UPDATE jobs SET status = 'queued', attempts = 0,
+                       not_before = 0, updated = ?
+                   WHERE status = 'failed'"""
+        args = (time.time(),)
+        if uid is not None:
+            query += " AND uid = ?"
+            args += (uid,)
+        with self._connect() as db:
+            return db.execute(query, args).rowcount
+
+    def _finish(self, job, status, error, not_before=0):
+        """ Whether the job was still leased to the caller and updated """
+        with self._connect() as db:
+            updated = db.execute(
+                """UPDATE jobs SET status = ?, error = ?, lease_until = NULL,
+                       not_before = ?, token = NULL, updated = ?
+                   WHERE uid = ? AND token = ? AND status = 'running'""",
+                (status, error, not_before, time.time(), job['uid'],
+                 job['token'])
+            ).rowcount > 0
+        if not updated:
+            print("[SPOOL ERROR]:", job['uid'],
+                  "lease taken over by another worker", file=sys.stderr)
+            return False
+        # Failed jobs keep their data, to be requeued:
+        if status == 'done':
+            path = os.path.join(self.datadir, job['uid'])
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def status(self, uid):
+        """ Progress of a job
+
+            Returns (dict):
+                Status of the job, None if no such job exists
+        """
+        job = self._connect().execute(
+            "SELECT * FROM jobs WHERE uid = ?", (uid,)
+        ).fetchone()
+        if job is None:
+            return None
+        return {
+            'uid': job['uid'],
+            'status': job['status'],
+            'labels_stored': bool(job['label_done']),
+            'data_stored': bool(job['data_done']),
+            'attempts': job['attempts'],
+            'error': job['error'],
+        }
+
+
+class SpoolWorkers:
+    """ Threads draining a Spool through the label and data actors
+
+        The threads are started lazily, and again after a fork, so the
+        workers can be created before gunicorn forks.
+
+        Args:
+            spool (Spool): Spool to drain
+            label_actor (Actor): Actor for the labels
+            data_actor (Actor): Actor for the data
+            n (int): Number of worker threads
+            poll_interval (float): Seconds to wait when the spool is empty
+            dedup (HashIndex): Index to register the data of the jobs in,
+                once stored
+    """
+    def __init__(self, spool, label_actor, data_actor, n=2, poll_interval=1,
+                 dedup=None):
+        self.spool = spool
+        self.label_actor = label_actor
+        self.data_actor = data_actor
+        self.dedup = dedup
+        self.n = int(n)
+        self.poll_interval = float(poll_interval)
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """ Start the threads, unless already running in this process """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._threads = [
+                threading.Thread(target=self.run, daemon=True)
+                for _ in range(self.n)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """ Stop the threads after their current jobs """
+        self._stop.set()
+        if self._pid == os.getpid():
+            for thread in self._threads:
+                thread.join()
+            self._pid = None
+
+    def run(self):
+        """ Process jobs until stopped """
+        while not self._stop.is_set():
+            try:
+                job = self.spool.claim()
+            except sqlite3.Error as e:
+                print("[SPOOL ERROR]:", str(e), file=sys.stderr)
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.process(job)
+
+    def process(self, job):
+        """ Run the actors of the stages not yet done for a claimed job """
+        uid = job['uid']
+        try:
+            labels, data = self.spool.load(job)
+        except (OSError, ValueError) as e:
+            print("[SPOOL ERROR]:", uid, str(e), file=sys.stderr)
+            self.spool.fail(job, f"Could not load job: {e}")
+            return
+
+        stages = []
+        if not job['label_done']:
+            stages.append(('LABEL', self.label_actor, labels))
+        if not job['data_done']:
+            stages.append(('DATA', self.data_actor, data))
+        # Keep the lease while the actors run, however long they take:
+        stop = threading.Event()
+        renewer = threading.Thread(
+            target=self._renew, args=(job, stop), daemon=True
+        )
+        renewer.start()
+        try:
+            results = run_actors([(a, d, uid) for _, a, d in stages])
+        finally:
+            stop.set()
+            renewer.join()
+            if isinstance(data, FileStorage):
+                data.stream.close()
+
+        errors = []
+        done = {}
+        for (stage, _, _), stage_results in zip(stages, results):
+            failed = [r for r in stage_results if r.error is not None]
+            for r in failed:
+                print(f"[{stage} ACTOR ERROR]:", uid, str(r.error),
+                      file=sys.stderr)
+                errors.append(f"{stage}: {r.error}")
+            done[stage] = not failed
+
+        self.spool.mark(job, label_done=done.get('LABEL', False),
+                        data_done=done.get('DATA', False))
+        if done.get('DATA'):
+            self._register(job)
+        if errors:
+            self.spool.fail(job, '; '.join(errors))
+        else:
+            self.spool.done(job)
+
+    def _renew(self, job, stop):
+        """ Extend the lease of a job every third of it until stopped """
+        while not stop.wait(self.spool.lease / 3):
+            try:
+                if not self.spool.extend(job):
+                    return
+            except sqlite3.Error as e:
+                print("[SPOOL ERROR]:", job['uid'], str(e), file=sys.stderr)
+
+    def _register(self, job):
+        """ Let later uploads link to the data of the job, now stored """
+        if self.dedup is None or not job['digest']:
+            return
+        try:
+            self.dedup.add(job['digest'], job['uid'])
+        except Exception as e:
+            print("[DEDUP ERROR]:", job['uid'], str(e), file=sys.stderr)
@@ -0,0 +1,253 @@
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_options_header
+import io
+import queue
+
+
+# Bytes read from the request body at once:
+STREAM_CHUNK = 64 * 1024
+# Chunks waiting for each reader of a pipe at most:
+PIPE_DEPTH = 4
+# Largest form field, e.g. the labels, read into memory:
+MAX_FIELD_SIZE = 1024 * 1024
+# Largest header block of a part:
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class ForwardStream(io.RawIOBase):
+    """ Base for streams read only forward, as a request body arrives
+
+        Seeking to where the stream already is works, since the actors
+        and the spool rewind the data before reading it.
+    """
+    _pos = 0
+
+    def readinto(self, b):
+        chunk = self.read(len(b))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        if whence == io.SEEK_END or offset != self._pos:
+            raise io.UnsupportedOperation("Cannot seek a streamed upload")
+        return self._pos
+
+
+class MultipartStream(ForwardStream):
+    """ Incremental reader of a multipart/form-data body
+
+        The parts are read in order, straight from the body stream, so a
+        file part can be passed on while the rest of it is still coming.
+        Only about one chunk of the body is held in memory at a time.
+        Reading the stream reads the current part.
+
+        Args:
+            stream (file-like): The body, e.g. request.stream
+            boundary (str): Boundary of the parts, from the content type
+            chunk_size (int): Bytes to read from the body at once
+    """
+    def __init__(self, stream, boundary, chunk_size=STREAM_CHUNK):
+        super().__init__()
+        if not boundary:
+            raise ValueError("No multipart boundary given")
+        self.chunk_size = int(chunk_size)
+        self._stream = stream
+        self._delimiter = b'\r\n--' + boundary.encode('latin-1')
+        # The preamble is skipped as if it was the content of a part:
+        self._buffer = b'\r\n'
+        self._in_part = True
+        self._eof = False
+        self._done = False
+
+    def next_part(self):
+        """ Skip the rest of the current part and start the next one
+
+            Returns (tuple):
+                name, filename (None for form fields) and the Headers of
+                the part. None when there are no more parts.
+
+            Raises:
+                ValueError: if the body is not valid multipart
+        """
+        while self._in_part:
+            self.read(self.chunk_size)
+        if self._done:
+            return None
+
+        n = len(self._delimiter)
+        self._fill(n + 2)
+        if self._buffer[n:n+2] == b'--':
+            self._done = True
+            return None
+        self._buffer = self._buffer[n:]
+
+        end = self._buffer.find(b'\r\n\r\n')
+        while end < 0:
+            if self._eof or len(self._buffer) > MAX_HEADER_SIZE:
+                raise ValueError("Invalid multipart part headers")
+            self._fill(len(self._buffer) + 1)
+            end = self._buffer.find(b'\r\n\r\n')
+        headers = Headers()
+        for line in self._buffer[:end].split(b'\r\n'):
+            if not line.strip():
+                continue
+            key, sep, value = line.decode('utf-8').partition(':')
+            if not sep:
+                raise ValueError("Invalid multipart part headers")
+            headers.add(key.strip(), value.strip())
+        self._buffer = self._buffer[end+4:]
+        self._in_part = True
+        self._pos = 0
+
+        _, options = parse_options_header(
+            headers.get('Content-Disposition', '')
+        )
+        return options.get('name'), options.get('filename'), headers
+
+    def read(self, size=-1):
+        """ Read from the current part, b'' at its end
+
+            Raises:
+                ValueError: if the body ends before the part
+        """
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self.chunk_size), b''))
+        n = len(self._delimiter)
+        out = []
+        left = size
+        while left > 0 and self._in_part:
+            self._fill(n + min(left, self.chunk_size))
+            end = self._buffer.find(self._delimiter)
+            if end >= 0:
+                available = end
+            elif self._eof:
+                raise ValueError("Multipart body ended unexpectedly")
+            else:
+                # The tail might be the start of the delimiter:
+                available = len(self._buffer) - n + 1
+            take = min(available, left)
+            out.append(self._buffer[:take])
+            self._buffer = self._buffer[take:]
+            left -= take
+            if take == end:
+                self._in_part = False
+        self._pos += size - left
+        return b''.join(out)
+
+    def unread(self, data):
+        """ Put data read from the current part back to be read again """
+        self._buffer = bytes(data) + self._buffer
+        self._in_part = True
+        self._pos -= len(data)
+
+    def read_field(self):
+        """ Read the rest of the current part as a form field
+
+            Returns (str):
+                The value
+
+            Raises:
+                ValueError: if larger than MAX_FIELD_SIZE
+        """
+        value = self.read(MAX_FIELD_SIZE + 1)
+        if len(value) > MAX_FIELD_SIZE:
+            raise ValueError("Form field too large")
+        return value.decode('utf-8')
+
+    def _fill(self, n):
+        """ Read until the buffer has n bytes or the body ends """
+        while len(self._buffer) < n and not self._eof:
+            chunk = self._stream.read(self.chunk_size)
+            if chunk:
+                self._buffer += chunk
+            else:
+                self._eof = True
+
+
+class Pipe:
+    """ Passes a stream written in one thread to readers in others
+
+        Every reader gets all the chunks written. At most depth chunks
+        wait for a reader, so a slow reader slows down the writer instead
+        of the stream piling up in memory. Readers closed early, e.g. by
+        a failed actor, are skipped.
+
+        Args:
+            depth (int): Chunks waiting for each reader at most
+    """
+    def __init__(self, depth=PIPE_DEPTH):
+        self.depth = int(depth)
+        self._readers = []
+
+    def reader(self):
+        """ A new reader of the stream. Create before writing. """
+        reader = PipeReader(self)
+        self._readers.append(reader)
+        return reader
+
+    @property
+    def closed(self):
+        """ Whether no reader is left """
+        return all(reader.closed for reader in self._readers)
+
+    def write(self, chunk):
+        chunk = bytes(chunk)
+        for reader in self._readers:
+            reader._put(chunk)
+        return len(chunk)
+
+    def close(self, error=None):
+        """ End the stream, with an error raised to the readers if given """
+        for reader in self._readers:
+            reader._put(error if error is not None else _END)
+
+
+class PipeReader(ForwardStream):
+    """ Reading end of a Pipe """
+    def __init__(self, pipe):
+        super().__init__()
+        self.pipe = pipe
+        self._queue = queue.Queue(pipe.depth)
+        self._buffer = bytearray()
+        self._pos = 0
+        self._end = False
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+        while not self._end and len(self._buffer) < size:
+            item = self._queue.get()
+            if item is _END:
+                self._end = True
+            elif isinstance(item, Exception):
+                self._end = True
+                raise item
+            else:
+                self._buffer += item
+        size = min(size, len(self._buffer))
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._pos += len(chunk)
+        return chunk
+
+
+_END = object()
@@ -0,0 +1,247 @@
+from contextlib import contextmanager
+from werkzeug.datastructures import FileStorage
+from librarian.exceptions import UploadOffsetError
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+try:
+    import fcntl
+except ImportError: # Not available on windows
+    fcntl = None
+
+
+# Bytes written to the staged file at once:
+UPLOAD_CHUNK = 1024 * 1024
+# Seconds between looking for expired uploads at most:
+EXPIRE_INTERVAL = 300
+
+
+class UploadSessions:
+    """ Resumable uploads staged in a local directory
+
+        Every upload has a directory of its own, with the data received
+        so far in "data" and the rest of its state in "session.json".
+        As all of it is on disk, any process of the service can continue
+        an upload, and a dropped connection loses only what did not reach
+        the disk. Chunks are written in order: a chunk is accepted only
+        at the offset the upload has reached so far.
+
+        Args:
+            directory (str): Directory for the uploads. Will be created
+                if doesn't exist
+            max_size (int): Largest upload accepted, in bytes. None for
+                no limit
+            max_age (float): Seconds after which unfinished uploads are
+                removed
+            on_expire (callable): Called with the uid, filename and staged
+                state of an upload before it is removed for its age, e.g.
+                the discard() of the data actors
+    """
+    def __init__(self, directory, max_size=None, max_age=24*3600,
+                 on_expire=None):
+        self.directory = directory
+        self.max_size = int(max_size) if max_size is not None else None
+        self.max_age = float(max_age)
+        self.on_expire = on_expire
+        self._expired_at = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __str__(self):
+        return (f"{self.__class__.__name__}:\n\tdirectory: {self.directory}"
+                f"\n\tmax_size: {self.max_size}\n\tmax_age: {self.max_age}")
+
+    def create(self, uid, labels, filename, size=None):
+        """ Start a new upload
+
+            Args:
+                uid (str): uid of the upload, also used for the stored data
+                labels (dict): Labels of the upload
+                filename (str): Filename of the data
+                size (int): Size of the whole upload, if known
+
+            Returns (dict):
+                The session
+        """
+        os.makedirs(self._path(uid))
+        open(self._path(uid, 'data'), 'wb').close()
+        open(self._path(uid, 'lock'), 'wb').close()
+        session = {
+            'uid': uid, 'labels': labels, 'filename': filename,
+            'size': size, 'staged': {}, 'created': time.time(),
+        }
+        self._save(session)
+        return dict(session, offset=0)
+
+    def get(self, uid):
+        """ The session of an upload, None if there is no such upload
+
+            Returns (dict):
+                uid, labels, filename, size (None if not known), offset
+                (bytes received so far) and staged (what the actors have
+                stored so far)
+        """
+        try:
+            with open(self._path(uid, 'session.json')) as f:
+                session = json.load(f)
+            session['offset'] = os.path.getsize(self._path(uid, 'data'))
+        except (KeyError, FileNotFoundError, ValueError):
+            return None
+        return session
+
+    def update(self, uid, **fields):
+        """ Change fields of the session of an upload """
+        session = self.get(uid)
+        if session is not None:
+            session.update(fields)
+            self._save(session)
+
+    def write(self, uid, offset, stream):
+        """ Write a chunk of an upload from a stream
+
+            What was read from the stream is kept even if reading fails,
+            e.g. when the client goes away.
+
+            Args:
+                uid (str): uid of the upload
+                offset (int): Offset the chunk starts at
+                stream (file-like): Stream to read the chunk from
+
+            Returns (int):
+                The offset reached
+
+            Raises:
+                KeyError: if there is no such upload
+                UploadOffsetError: if offset is not where the upload is
+                ValueError: if the upload would grow over its size
+        """
+        session = self.get(uid)
+        if session is None:
+            raise KeyError(uid)
+        if offset != session['offset']:
+            raise UploadOffsetError(
+                session['offset'],
+                f"Upload is at offset {session['offset']}, not {offset}"
+            )
+        limits = [n for n in (session['size'], self.max_size) if n is not None]
+        limit = min(limits) if limits else None
+        with open(self._path(uid, 'data'), 'r+b') as f:
+            f.seek(offset)
+            try:
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK), b''):
+                    if limit is not None and offset + len(chunk) > limit:
+                        f.truncate(session['offset'])
+                        raise ValueError(f"Upload larger than {limit} bytes")
+                    f.write(chunk)
+                    offset += len(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+        return offset
+
+    def open(self, uid, name=None):
+        """ The data of an upload as a FileStorage, to be closed after use """
+        session = self.get(uid)
+        if session is None:
+            raise KeyError(uid)
+        return FileStorage(
+            stream=open(self._path(uid, 'data'), 'rb'),
+            filename=session['filename'], name=name
+        )
+
+    def remove(self, uid):
+        try:
+            shutil.rmtree(self._path(uid), ignore_errors=True)
+        except KeyError:
+            pass
+
+    def expire(self, force=False):
+        """ Remove the uploads not written to in max_age seconds
+
+            The uploads are looked through at most every EXPIRE_INTERVAL
+            seconds in a process, unless forced. An upload whose
+            on_expire fails is kept, to be tried again later. Must not be
+            called while holding the lock of an upload.
+
+            Args:
+                force (bool): Look through the uploads now
+
+            Returns (int):
+                Number of uploads removed
+        """
+        now = time.time()
+        if not force and now - self._expired_at < min(EXPIRE_INTERVAL,
+                                                      self.max_age):
+            return 0
+        self._expired_at = now
+        removed = 0
+        for uid in os.listdir(self.directory):
+            try:
+                if not self._expired(uid, now):
+                    continue
+                with self.lock(uid):
+                    # Might have been resumed meanwhile:
+                    session = self.get(uid)
+                    if session is None or not self._expired(uid, now):
+                        continue
+                    if self.on_expire is not None:
+                        self.on_expire(uid, session['filename'],
+                                       session['staged'])
+                    self.remove(uid)
+                    removed += 1
+            except (KeyError, OSError):
+                continue
+            except Exception as e:
+                print("[UPLOAD ERROR]: Could not expire", uid, str(e),
+                      file=sys.stderr)
+        return removed
+
+    def _expired(self, uid, now):
+        return os.path.getmtime(self._path(uid, 'data')) < now - self.max_age
+
+    @contextmanager
+    def lock(self, uid):
+        """ Hold an upload for a single request at a time, in any process """
+        if fcntl is None:
+            with self._lock:
+                yield
+            return
+        try:
+            f = open(self._path(uid, 'lock'), 'rb')
+        except (KeyError, FileNotFoundError):
+            # No such upload, which the caller finds out:
+            yield
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+            # Lock is released on close
+
+    def _save(self, session):
+        session = {k: v for k, v in session.items() if k != 'offset'}
+        path = self._path(session['uid'], 'session.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(session, f)
+        os.replace(path + '.tmp', path)
+
+    def _path(self, uid, *parts):
+        # The uids come from the url:
+        if not uid.isalnum():
+            raise KeyError(uid)
+        return os.path.join(self.directory, uid, *parts)
+
+
+def configure_uploads(config, on_expire=None):
+    """ Create the upload sessions from UPLOAD_CONFIG, None if not set """
+    if not config:
+        return None
+    return UploadSessions(
+        config['directory'],
+        max_size=config.get('max_size'),
+        max_age=config.get('max_age', 24*3600),
+        on_expire=on_expire,
+    )
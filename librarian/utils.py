@@ -82,11 +82,14 @@ def load_configs_from_environment():
 
     Note, that if any of these is not found, the service will fail to start.
 
+    Optional: SPOOL_CONFIG, DEDUP_CONFIG, METRICS_CONFIG, PROFILE_CONFIG,
+    UPLOAD_CONFIG.
+
     Raises:
         ValueError: if env variable with name tag is not defined
         TypeError: if data in environment variable is not valid json
     """
-    return {
+    configs = {
         "INPUT_CONFIG":        load_env_json("INPUT_CONFIG"),
         "CROSS_VALID_CONFIG":  load_env_json("CROSS_VALID_CONFIG"),
         "LABEL_VALID_CONFIG":  load_env_json("LABEL_VALID_CONFIG"),
@@ -94,6 +97,14 @@ def load_configs_from_environment():
         "DATA_VALID_CONFIG":   load_env_json("DATA_VALID_CONFIG"),
         "DATA_ACTOR_CONFIG":   load_env_json("DATA_ACTOR_CONFIG"),
     }
+    # Optional configs:
+    for tag in [
+        "SPOOL_CONFIG", "DEDUP_CONFIG", "METRICS_CONFIG", "PROFILE_CONFIG",
+        "UPLOAD_CONFIG"
+    ]:
+        if tag in os.environ:
+            configs[tag] = load_env_json(tag)
+    return configs
 
 
 
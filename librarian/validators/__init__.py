@@ -1,24 +1,24 @@
 from librarian.validators import validator
 from librarian.validators import crossvalidators
-from librarian.validators import filevalidator
-from librarian.validators import typevalidator
-from librarian.validators import keyvalidator
-from librarian.validators import imagevalidator
+from librarian.registry import LazyRegistry
+import os
 
 
+# The modules are imported when the validators are first configured:
+validators = LazyRegistry({
+    'file': 'librarian.validators.filevalidator:FileValidator',
+    'type': 'librarian.validators.typevalidator:TypeValidator',
+    'key':  'librarian.validators.keyvalidator:KeyValidator',
+    'range': 'librarian.validators.rangevalidator:RangeValidator',
+    'img': 'librarian.validators.imagevalidator:ImageValidator',
+    'dhash': 'librarian.validators.duplicatevalidator:NearDuplicateValidator',
+    'none': 'librarian.validators.validator:DummyValidator',
+})
 
-validators = {
-    'file': filevalidator.FileValidator,
-    'type': typevalidator.TypeValidator,
-    'key':  keyvalidator.KeyValidator,
-    'img': imagevalidator.ImageValidator,
-    'none': validator.DummyValidator
-}
-
-xvalidators = {
-    'none': crossvalidators.DummyCrossValidator,
-    'fname': crossvalidators.MacthFileNames
-}
+xvalidators = LazyRegistry({
+    'none': 'librarian.validators.crossvalidators:DummyCrossValidator',
+    'fname': 'librarian.validators.crossvalidators:MacthFileNames',
+})
 
 
 
@@ -26,7 +26,10 @@ def configure_validator(config):
     """ Create a validator using configuration
 
         All the different validators given in config are composed into
-        one single Validator. The validations are done in order given.
+        one single Validator, compiled into a flat list of checks. The
+        validations are done in order given, stopping at the first failure.
+        If the environment variable ADAPTIVE_VALIDATION is set to 1, the
+        order is adapted to the measured costs and rejection rates.
 
         Args:
             config (list): List of config dicts to create the validator
@@ -40,31 +43,19 @@ def configure_validator(config):
     # No validato used, return just a dummy:
     if len(config) == 0:
         return validator.DummyValidator()
-
-    # Single validator
-    elif len(config) == 1:
-        config = config[0]
-        tag = config['validator']
-        args = config['args']
-        kwargs = config.get('kwargs', {})
-        return validators[tag](*args, **kwargs)
-
-    # Compose a validator using multiple validators:
-    else:
-        composite = validator.CompositeValidator()
-        for c in config:
-            tag = c['validator']
-            args = c.get('args',[])
-            kwargs = c.get('kwargs', {})
-            composite += validators[tag](*args, **kwargs)
-        return composite
+    return validator.CompositeValidator(
+        *_create(validators, config), adaptive=_adaptive()
+    )
 
 
 def configure_xvalidator(config):
     """ Create a cross validator using configuration
 
         All the different validators given in config are composed into
-        one single Validator. The validations are done in order given.
+        one single Validator, compiled into a flat list of checks. The
+        validations are done in order given, stopping at the first failure.
+        If the environment variable ADAPTIVE_VALIDATION is set to 1, the
+        order is adapted to the measured costs and rejection rates.
 
         Args:
             config (list): List of config dicts to create the validator
@@ -78,22 +69,18 @@ def configure_xvalidator(config):
     # No validato used, return just a dummy:
     if len(config) == 0:
         return crossvalidators.DummyCrossValidator()
+    return crossvalidators.CompositeCrossValidator(
+        *_create(xvalidators, config), adaptive=_adaptive()
+    )
+
+
+def _adaptive():
+    return os.environ.get('ADAPTIVE_VALIDATION', '0') == '1'
 
-    # Single validator
-    elif len(config) == 1:
-        config = config[0]
-        tag = config['validator']
-        args = config.get('args',[])
-        kwargs = config.get('kwargs', {})
-        return xvalidators[tag](*args, **kwargs)
-
-    # Compose a validator using multiple validators:
-    else:
-        composite = crossvalidators.CompositeCrossValidator()
-        for c in config:
-            tag = c['validator']
-            args = c.get('args',[])
-            kwargs = c.get('kwargs', {})
-            composite += xvalidators[tag](*args, **kwargs)
-        return composite
 
+def _create(options, config):
+    for c in config:
+        tag = c['validator']
+        args = c.get('args',[])
+        kwargs = c.get('kwargs', {})
+        yield options[tag](*args, **kwargs)
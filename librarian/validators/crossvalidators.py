@@ -20,7 +20,7 @@ class DummyCrossValidator(Validator):
 
 
 
-class MacthFileNames:
+class MacthFileNames(Validator):
     """ Cross validator to check if two objects contain same filenames
 
         Tries to access "filenames" from the data with .get()
@@ -38,16 +38,16 @@ class MacthFileNames:
         fn1 = x.get('filename', False)
         fn2 = y.get('filename', False)
 
-        return (fn1 and f2) and fn1 == fn2
+        return bool(fn1 and fn2) and fn1 == fn2
 
 
 class CompositeCrossValidator(CompositeValidator):
-    def __init__(self, *xvalidators):
+    def __init__(self, *xvalidators, **kwargs):
         self.description = "Composed CrossValidator"
-        super().__init__(*xvalidators)
+        super().__init__(*xvalidators, **kwargs)
 
     def __call__(self, x, y):
-        return all([validate(x,y) for validate in self.validators])
+        return self._run(x, y)
 
     def __str__(self):
         string = self.__class__.__name__ +" with Cross Validators:\n"
@@ -0,0 +1,159 @@
+from librarian.validators.validator import Validator
+from librarian.validators.exceptions import ValidationError
+from librarian.artifacts import cached, decoded_image
+import numpy as np
+import os
+import struct
+import threading
+try:
+    import fcntl
+except ImportError: # Not available on windows
+    fcntl = None
+try:
+    _popcount = int.bit_count
+except AttributeError: # Python < 3.10
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+class NearDuplicateValidator(Validator):
+    """ Validator rejecting images similar to ones already accepted
+
+        Compares the difference hashes (dHash) of the images, which stay
+        the same when an image is re-encoded, resized or slightly edited.
+        The hashes of the images stored are kept in an index file shared
+        by all the processes. An image is added to the index only after
+        it is stored, so near duplicates uploaded at the same moment may
+        both be accepted.
+
+        Args:
+            index (str): File to keep the hashes in. If a path, the
+                directory should already exist!
+            distance (int): Images whose hashes differ by at most this
+                many bits (of 64) are near duplicates
+
+        Returns (bool):
+            Whether the validation was successful
+    """
+    # Accepted hashes are remembered:
+    pure = False
+    # Hashes the whole image:
+    streamable = False
+
+    def __init__(self, index: str, distance: int = 4):
+        super().__init__()
+        self.index = index
+        self.distance = int(distance)
+        self._hashes = HashIndex(index, self.distance)
+
+    def __call__(self, obj):
+        try:
+            h = dhash(obj)
+        except Exception as e:
+            raise ValidationError("Could not open the image: "+str(e))
+
+        if self._hashes.find(h) is not None:
+            raise ValidationError("Image is a near duplicate of an earlier one")
+        return True
+
+    def commit(self, obj):
+        """ Remember the image, now that it is stored """
+        self._hashes.add(dhash(obj))
+
+
+def dhash(data):
+    """ 64 bit difference hash of an image
+
+        The image is shrunk to 9x8 gray pixels, and each bit tells if a
+        pixel is brighter than its left neighbour.
+
+        Args:
+            data (FileStorage): The image file
+
+        Returns (int):
+            The hash
+    """
+    return cached(data, 'dhash', _dhash)
+
+
+def _dhash(data):
+    from PIL import Image
+    im = decoded_image(data)
+    # The box filter averages all the pixels, which evens out noise:
+    small = im.convert('L').resize((9, 8), Image.BOX)
+    px = np.asarray(small, dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class HashIndex:
+    """ Index of 64 bit hashes for finding the ones within a distance
+
+        The hashes are split in distance+1 chunks of bits. Two hashes
+        differing by at most distance bits must then have at least one
+        identical chunk, so only the hashes sharing a chunk with the one
+        looked up need to be compared. With millions of hashes that is a
+        few hundred comparisons instead of a walk through a large part
+        of a BK-tree.
+
+        The hashes are persisted to an append-only file. Hashes appended
+        by other processes are read before every lookup.
+
+        Args:
+            path (str): File of the hashes, 8 bytes each
+            distance (int): Largest distance to look for
+    """
+    def __init__(self, path, distance):
+        self.path = path
+        self.distance = int(distance)
+        self.size = 0
+        self._offset = 0
+        self._lock = threading.Lock()
+
+        # (shift, mask) of the chunks and a table for each:
+        n = self.distance + 1
+        widths = [64 // n + (i < 64 % n) for i in range(n)]
+        shifts = [sum(widths[:i]) for i in range(n)]
+        self._chunks = [(s, (1 << w) - 1) for s, w in zip(shifts, widths)]
+        self._tables = [{} for _ in range(n)]
+        with self._lock:
+            self._refresh()
+
+    def find(self, h):
+        """ A stored hash at most distance bits from h, None if none """
+        with self._lock:
+            self._refresh()
+            for (shift, mask), table in zip(self._chunks, self._tables):
+                for candidate in table.get((h >> shift) & mask, ()):
+                    if _popcount(candidate ^ h) <= self.distance:
+                        return candidate
+            return None
+
+    def add(self, h):
+        """ Store a hash to the index and the file """
+        with self._lock, open(self.path, 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # Take in what others wrote first, to keep the offset right:
+            self._refresh()
+            f.write(struct.pack('>Q', h))
+            f.flush()
+            self._offset += 8
+            self._insert(h)
+
+    def _refresh(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            new = f.read()
+        # Skip a hash being written right now:
+        new = new[:len(new) - len(new) % 8]
+        self._offset += len(new)
+        for (h,) in struct.iter_unpack('>Q', new):
+            self._insert(h)
+
+    def _insert(self, h):
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((h >> shift) & mask, []).append(h)
+        self.size += 1
@@ -4,8 +4,16 @@ class InitialisationError(Exception):
 
 
 class ValidationError(Exception):
-    def __init__(self,*args,**kwargs):
-        super().__init__(*args, **kwargs)
+    """ Raised when an object does not pass a validator
+
+        Args:
+            validator (str): Name of the failed validator, if known
+            field (str): Name of the offending field, if any
+    """
+    def __init__(self, *args, validator=None, field=None):
+        super().__init__(*args)
+        self.validator = validator
+        self.field = field
 
 
 class ConfigurationError(Exception):
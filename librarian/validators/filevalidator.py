@@ -18,6 +18,7 @@ class FileValidator(Validator):
     def __init__(self, filetypes: list):
         super().__init__()
         self.filetypes = filetypes
+        self._suffixes = tuple(filetypes)
 
     def __call__(self, obj):
-        return any([obj.filename.endswith(ft) for ft in self.filetypes])
\ No newline at end of file
+        return obj.filename.endswith(self._suffixes)
\ No newline at end of file
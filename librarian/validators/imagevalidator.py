@@ -1,13 +1,16 @@
 from librarian.validators.validator import Validator
 from librarian.validators.exceptions import ValidationError, InitialisationError
-from PIL import Image
+from librarian.artifacts import image_info, decoded_image
 
 class ImageValidator(Validator):
     """ Validator for checking if file is a valid image
 
-        Checks for load, pillow verify and height and width
+        Checks for load, height and width, and that the image decodes
         NOTE: Use h, w = 0,0 to skip dimension check
 
+        The header facts and the decoded image are cached with the data,
+        so later validators and actors do not decode the image again.
+
         Args:
             h (int): height of the image
             w (int): width of the image
@@ -15,6 +18,9 @@ class ImageValidator(Validator):
         Returns (bool):
             Whether the validation was successful
     """
+    # Decodes the whole image:
+    streamable = False
+
     def __init__(self, h: int, w: int):
         super().__init__()
         self.h = int(h)
@@ -22,17 +28,15 @@ class ImageValidator(Validator):
 
     def __call__(self, obj):
         try:
-            im = Image.open(obj)
+            info = image_info(obj)
         except Exception as e:
             raise ValidationError("Could not open the image: "+str(e))
 
-        if (self.h and im.height != self.h) or (self.w and im.width != self.w):
-            print("1", (self.h and im.height != self.h))
-            print("2", (self.w and im.width != self.w))
+        if (self.h and info['height'] != self.h) or (self.w and info['width'] != self.w):
             raise ValidationError("Image dimensions do not match")
 
         try:
-            im.verify()
+            decoded_image(obj)
         except Exception as e:
             raise ValidationError("Could not verify the image: "+str(e))
-
+        return True
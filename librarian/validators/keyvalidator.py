@@ -1,5 +1,5 @@
 from librarian.validators.validator import Validator
-from librarian.validators.exceptions import ValidationError
+from librarian.validators.exceptions import ValidationError, InitialisationError
 
 
 class KeyValidator(Validator):
@@ -16,7 +16,8 @@ class KeyValidator(Validator):
         if not isinstance(keys, list):
             raise InitialisationError("Invalid arguments")
         super().__init__()
-        self.keys = set(keys)
+        self.keys = frozenset(keys)
 
     def __call__(self, obj):
-        return set(obj.keys()) == self.keys
\ No newline at end of file
+        # Key views compare to sets without building a new one:
+        return obj.keys() == self.keys
@@ -0,0 +1,91 @@
+from librarian.validators.validator import Validator
+from librarian.validators.exceptions import ValidationError, ConfigurationError
+from librarian.validators.exceptions import InitialisationError
+import numpy as np
+
+
+class RangeValidator(Validator):
+    """ Validator for the values of numeric label fields
+
+        arg example: {"x": {"min": 0, "max": 640}, "class": {"values": [0, 1]}}
+        Every field given must be a number (not a bool) within the limits
+        and/or among the allowed values. The limits are inclusive, and any
+        of "min", "max" and "values" can be left out.
+
+        A batch of objects is checked a field at a time with NumPy, see
+        validate_many.
+
+        Args:
+            config (dict): fields to be checked and their limits
+
+        Returns (bool):
+            Whether the validation was successful
+    """
+    def __init__(self, config: dict):
+        if not isinstance(config, dict):
+            raise InitialisationError("Invalid arguments")
+        super().__init__()
+        self.config = config
+        self._checks = []
+        for field, limits in config.items():
+            unknown = set(limits) - {'min', 'max', 'values'}
+            if unknown:
+                raise ConfigurationError(
+                    f"Unknown limits for {field}: {sorted(unknown)}"
+                )
+            values = limits.get('values')
+            self._checks.append((
+                field, limits.get('min'), limits.get('max'),
+                None if values is None else np.asarray(values, dtype=float)
+            ))
+
+    def __call__(self, obj):
+        for field, low, high, values in self._checks:
+            val = obj.get(field)
+            if not _is_number(val):
+                raise ValidationError(f"Field {field} is not a number",
+                                      validator='RangeValidator', field=field)
+            if ((low is not None and val < low)
+                    or (high is not None and val > high)
+                    or (values is not None and val not in values)):
+                raise ValidationError(f"Value {val} of {field} not allowed",
+                                      validator='RangeValidator', field=field)
+        return True
+
+    def validate_many(self, objs):
+        """ Validate a batch of objects column-wise
+
+            Args:
+                objs (list of dicts): Objects to validate
+
+            Returns (list of bool):
+                Whether each object passed the validation
+        """
+        objs = list(objs)
+        mask = np.ones(len(objs), dtype=bool)
+        for field, low, high, values in self._checks:
+            # Missing and non-numeric values become NaN, which fails all:
+            column = np.fromiter(
+                (_as_float(obj.get(field)) for obj in objs),
+                dtype=float, count=len(objs)
+            )
+            with np.errstate(invalid='ignore'):
+                ok = ~np.isnan(column)
+                if low is not None:
+                    ok &= column >= low
+                if high is not None:
+                    ok &= column <= high
+                if values is not None:
+                    ok &= np.isin(column, values)
+            mask &= ok
+        return mask.tolist()
+
+
+def _is_number(val):
+    # NaN is not equal to itself:
+    return (isinstance(val, (int, float)) and not isinstance(val, bool)
+            and val == val)
+
+
+def _as_float(val):
+    return float(val) if _is_number(val) else np.nan
@@ -1,5 +1,6 @@
 from librarian.validators.validator import Validator
 from librarian.validators.exceptions import ValidationError, ConfigurationError
+from librarian.validators.exceptions import InitialisationError
 
 
 class TypeValidator(Validator):
@@ -37,15 +38,23 @@ class TypeValidator(Validator):
             if not t:
                 raise ConfigurationError(f"Supplied type not supported: {v}")
             self.validation_dict[k] = t
+        # Precomputed once, iterated on every call:
+        self._checks = tuple(self.validation_dict.items())
 
-    def __call__(self, obj):
-        for key, val in iter(self.validation_dict.items()):
-            if key not in obj:
-                raise ValidationError(f"Required field {key} not found")
+    def schema(self):
+        return dict(self.validation_dict)
 
-            if not isinstance(obj[key], self.validation_dict[key]):
+    def __call__(self, obj):
+        for key, expected in self._checks:
+            try:
+                val = obj[key]
+            except KeyError:
+                raise ValidationError(f"Required field {key} not found",
+                                      validator='TypeValidator', field=key)
+            if not isinstance(val, expected):
                 raise ValidationError(
-                    f"Invalid type ({type(obj[key])})" +
-                    f" for {key}. Expected ({val})"
+                    f"Invalid type ({type(val)})" +
+                    f" for {key}. Expected ({expected})",
+                    validator='TypeValidator', field=key
             )
         return True
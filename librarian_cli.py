@@ -2,8 +2,14 @@ from librarian import validators
 from librarian import actors
 from librarian import exceptions as libex
 from librarian import describers
-from librarian import factory
 from librarian import utils
+from librarian import export as exporting
+from librarian import packer
+from librarian import dedup
+from librarian import metrics
+from librarian import profiling
+# NOTE: The service modules (factory, spool, the actors) are imported
+# by the commands needing them, to keep e.g. describe fast to start.
 
 from dotenv import load_dotenv
 
@@ -11,6 +17,8 @@ from dotenv import load_dotenv
 # import json
 import fire
 import os
+import sys
+import time
 
 
 def describe(validators=False, actors=False, inputs=False, xvalidators=False):
@@ -29,6 +37,138 @@ def describe(validators=False, actors=False, inputs=False, xvalidators=False):
 
 
 
+def compact(src, dst=None):
+    """ Compact a json lines file or convert an old json file to one
+
+    Drops broken lines and duplicate uids and rebuilds the offset index.
+    Should be run offline, i.e. while no Librarian is writing to the file.
+
+    Args:
+        src (str): json or json lines file to compact
+        dst (str): file to write to. Defaults to replacing src.
+
+    """
+    from librarian.actors.local_actors import compact_json_lines
+    n = compact_json_lines(src, dst)
+    print(f"Wrote {n} records to {dst or src}")
+
+
+
+def export(out=None, dotenv=None, json=None, fields=None, batch_size=1000,
+           **filters):
+    """ Export the stored labels as newline delimited json
+
+    Reads the labels from the label actor of the configuration, e.g.
+    mongo, as a stream, so any number of labels can be exported.
+
+    Args:
+        out    (str): File to write to. Defaults to stdout.
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+        fields (str): Comma separated fields to export. Defaults to all.
+        batch_size (int): Labels to fetch from storage at once
+        **filters: Values the label fields must equal, e.g. --x=10
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    lbl_actor = actors.configure_actor(config_kwargs["LABEL_ACTOR_CONFIG"])
+    if isinstance(fields, str):
+        fields = [f for f in fields.split(',') if f]
+
+    try:
+        if out:
+            with open(out, 'wb') as f:
+                written = exporting.export_ndjson(
+                    lbl_actor, f, filters, fields, batch_size
+                )
+            print(f"Wrote {written} bytes to {out}")
+        else:
+            exporting.export_ndjson(
+                lbl_actor, sys.stdout.buffer, filters, fields, batch_size
+            )
+    except NotImplementedError as e:
+        print("Cannot export:", str(e))
+
+
+
+def validate(dotenv=None, json=None, batch_size=1000, **filters):
+    """ Validate the stored labels again with the label validator
+
+    Useful after changing the LABEL_VALID_CONFIG. The labels are read
+    from the label actor of the configuration and validated in batches.
+    The uids of the labels failing are printed.
+
+    Args:
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+        batch_size (int): Labels to validate at once
+        **filters: Values the label fields must equal, e.g. --x=10
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    lbl_actor = actors.configure_actor(config_kwargs["LABEL_ACTOR_CONFIG"])
+    lbl_valid = validators.configure_validator(
+        config_kwargs["LABEL_VALID_CONFIG"]
+    )
+
+    total, failed = 0, 0
+    try:
+        for labels, passed in exporting.revalidate(
+                lbl_actor, lbl_valid, filters, batch_size):
+            total += 1
+            if not passed:
+                failed += 1
+                print(labels.get('uid', labels))
+    except NotImplementedError as e:
+        print("Cannot validate:", str(e))
+        return
+    print(f"{failed} of {total} labels failed the validation", file=sys.stderr)
+
+
+
+def pack(out, dotenv=None, json=None, shard_size=1024**3, shard_count=0,
+         workers=16, keep_missing=False, **filters):
+    """ Pack the stored labels and data into tar shards for training
+
+    Joins the labels of the label actor and the data of the data actor
+    of the configuration by uid, into WebDataset style tar shards with a
+    manifest.json.
+
+    Args:
+        out    (str): Directory to write the shards to
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+        shard_size (int): Bytes per shard, at most about
+        shard_count (int): Samples per shard at most, 0 for no limit
+        workers (int): Number of threads reading the data
+        keep_missing (bool): Pack also the labels without data
+        **filters: Values the label fields must equal, e.g. --x=10
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    lbl_actor = actors.configure_actor(config_kwargs["LABEL_ACTOR_CONFIG"])
+    data_actor = actors.configure_actor(config_kwargs["DATA_ACTOR_CONFIG"])
+
+    try:
+        manifest = packer.pack(
+            lbl_actor, data_actor, out, shard_size=shard_size,
+            shard_count=shard_count, workers=workers, filters=filters,
+            skip_missing=not keep_missing
+        )
+    except NotImplementedError as e:
+        print("Cannot pack:", str(e))
+        return
+    print(f"Packed {manifest['samples']} samples into",
+          f"{len(manifest['shards'])} shards in {out}")
+
+
+
 def launch(dotenv=None, json=None, test=False, port=5000, debug=True):
     """ Launches a Librarian instance as a flask app
 
@@ -79,39 +219,149 @@ def create(dotenv=False, json=False, test=False):
         An app ready to run.
 
     """
+    config_kwargs = _load_configs(dotenv, json, test)
+    # Something went wrong during loading:
+    if config_kwargs is None:
+        return
+
+    # creating_kwargs = utils.parse_config_dicts(**config_kwargs)
+    return _createnew(**config_kwargs)
+
+
+def work(dotenv=None, json=None):
+    """ Drains the spool of an asynchronous Librarian with the actors
+
+    Uses the same configuration as the service itself, which should
+    have a SPOOL_CONFIG. Runs until interrupted.
+
+    Args:
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    if not config_kwargs.get("SPOOL_CONFIG"):
+        _fail_config("No SPOOL_CONFIG defined")
+        return
+
+    config = config_kwargs["SPOOL_CONFIG"]
+    # workers=0 only disables the threads of the service itself:
+    n = config.get("workers") or 2
+    workers = _create_spool_workers(
+        config, actors.configure_actor(config_kwargs["LABEL_ACTOR_CONFIG"]),
+        actors.configure_actor(config_kwargs["DATA_ACTOR_CONFIG"]), n,
+        dedup.configure_dedup(config_kwargs.get("DEDUP_CONFIG"))
+    )
+    print("[SPOOL]:", str(workers.spool), '\n')
+    print(f"Draining the spool with {workers.n} workers ...")
+    workers.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping after the current jobs ...")
+        workers.stop()
+
+
+def requeue(uid=None, dotenv=None, json=None):
+    """ Put the spooled uploads failed for good back in the queue
+
+    Args:
+        uid    (str): Upload to requeue, all the failed ones if not given
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    if not config_kwargs.get("SPOOL_CONFIG"):
+        _fail_config("No SPOOL_CONFIG defined")
+        return
+    from librarian import spool
+    n = spool.Spool(config_kwargs["SPOOL_CONFIG"]["directory"]).requeue(uid)
+    print(f"Requeued {n} uploads")
+
+
+def expire(dotenv=None, json=None):
+    """ Remove the resumable uploads not written to in max_age seconds
+
+    The service does this itself every few minutes while it gets uploads.
+    Run e.g. from cron to also clean up after a service getting none.
+
+    Args:
+        dotenv (str): .env file to load for configuration
+        json   (str): json file to load for configuration
+
+    """
+    config_kwargs = _load_configs(dotenv, json, False)
+    if config_kwargs is None:
+        return
+    if not config_kwargs.get("UPLOAD_CONFIG"):
+        _fail_config("No UPLOAD_CONFIG defined")
+        return
+    from librarian import uploads
+    data_actor = actors.configure_actor(config_kwargs["DATA_ACTOR_CONFIG"])
+    sessions = uploads.configure_uploads(
+        config_kwargs["UPLOAD_CONFIG"], on_expire=data_actor.discard
+    )
+    print(f"Removed {sessions.expire(force=True)} expired uploads")
+
+
+def _load_configs(dotenv, json, test):
+    """ Load the configuration dicts, None on failure """
     if test:
-        config_kwargs = utils.load_test_configs()
+        return utils.load_test_configs()
 
     elif json:
         try:
-            config_kwargs = utils.load_configs_from_json(json)
+            return utils.load_configs_from_json(json)
         except FileNotFoundError as e:
             _fail_config(f'Defined config json file not found: {e}')
-            return
         except ValueError as e:
             _fail_config(f'Defined config json is not valid: {e}')
-            return
 
     else:
         if dotenv:
             load_dotenv(dotenv_path=dotenv)
         try:
-            config_kwargs = utils.load_configs_from_environment()
+            return utils.load_configs_from_environment()
         except KeyError as e:
             _fail_config(f'Environment variable not set: {e}')
-            return
         except libex.EnvironmentVariableLoadException as e:
             _fail_config(f'Error loading environment configs: {e}')
-            return
 
-    # creating_kwargs = utils.parse_config_dicts(**config_kwargs)
-    return _createnew(**config_kwargs)
+
+def _create_spool_workers(config, lbl_actor, data_actor, n, hash_index=None):
+    """ Create the spool and workers for it from SPOOL_CONFIG """
+    from librarian import spool
+    try:
+        spool_ = spool.Spool(
+            config["directory"],
+            max_attempts=config.get("max_attempts", 5),
+            lease=config.get("lease", 300),
+            retry_delay=config.get("retry_delay", 5),
+            max_retry_delay=config.get("max_retry_delay", 600),
+        )
+    except KeyError as e:
+        raise libex.InitialisationError(
+            f"Invalid Spool initialisation: {e}"
+        )
+    return spool.SpoolWorkers(
+        spool_, lbl_actor, data_actor, n=n,
+        poll_interval=config.get("poll_interval", 1), dedup=hash_index
+    )
 
 
 def _createnew(INPUT_CONFIG, CROSS_VALID_CONFIG, LABEL_VALID_CONFIG,
-               DATA_VALID_CONFIG, LABEL_ACTOR_CONFIG, DATA_ACTOR_CONFIG):
+               DATA_VALID_CONFIG, LABEL_ACTOR_CONFIG, DATA_ACTOR_CONFIG,
+               SPOOL_CONFIG=None, DEDUP_CONFIG=None, METRICS_CONFIG=None,
+               PROFILE_CONFIG=None, UPLOAD_CONFIG=None):
     """ Better creation of stuffs
     """
+    from librarian import factory
     try:
         data_type = INPUT_CONFIG["type"]
         data_tag =  INPUT_CONFIG["tag"]
@@ -137,11 +387,56 @@ def _createnew(INPUT_CONFIG, CROSS_VALID_CONFIG, LABEL_VALID_CONFIG,
             f"Invalid Actor initialisation: {e}"
         )
 
+    try:
+        hash_index = dedup.configure_dedup(DEDUP_CONFIG)
+    except (KeyError, TypeError) as e:
+        raise libex.InitialisationError(
+            f"Invalid Dedup initialisation: {e}"
+        )
+
+    try:
+        metrics_ = metrics.configure_metrics(METRICS_CONFIG)
+    except (OSError, TypeError) as e:
+        raise libex.InitialisationError(
+            f"Invalid Metrics initialisation: {e}"
+        )
+
+    try:
+        profiler = profiling.configure_profiler(PROFILE_CONFIG)
+    except (OSError, TypeError) as e:
+        raise libex.InitialisationError(
+            f"Invalid Profiler initialisation: {e}"
+        )
+
+    try:
+        from librarian import uploads
+        # Parts staged by the actors are dropped with expired uploads:
+        upload_sessions = uploads.configure_uploads(
+            UPLOAD_CONFIG, on_expire=data_actor.discard
+        )
+    except (KeyError, OSError, TypeError) as e:
+        raise libex.InitialisationError(
+            f"Invalid Uploads initialisation: {e}"
+        )
+
+    # Asynchronous mode, workers=0 to drain with "work" processes only:
+    spool_, workers = None, None
+    if SPOOL_CONFIG:
+        workers = _create_spool_workers(
+            SPOOL_CONFIG, lbl_actor, data_actor, SPOOL_CONFIG.get("workers", 2),
+            hash_index
+        )
+        spool_ = workers.spool
+        if workers.n == 0:
+            workers = None
+
     return factory.create_librarian(
         datatype=data_type, datatag=data_tag,
         label_validator=lbl_valid, label_actor=lbl_actor,
         data_validator=data_valid, data_actor=data_actor,
-        cross_validator=cross_valid
+        cross_validator=cross_valid, spool=spool_, spool_workers=workers,
+        dedup=hash_index, metrics=metrics_, profiler=profiler,
+        uploads=upload_sessions
     )
 
 
@@ -209,6 +504,13 @@ def _fail_config(message):
 if __name__ == "__main__":
     fire.Fire({
         'describe': describe,
+        'compact': compact,
+        'work': work,
+        'requeue': requeue,
+        'expire': expire,
+        'export': export,
+        'validate': validate,
+        'pack': pack,
         'launch': launch,
         'create': create,
     })